@@ -116,10 +116,17 @@ const Chatbot = () => {
 
     try {
       const currentUserType = userType;
-      
-      const res = await fetch("https://chatbot-ik3y.onrender.com/chat", {
+
+      // The login token lets the chatbot answer from the student's records
+      const headers = { "Content-Type": "application/json" };
+      const token = localStorage.getItem(`${currentUserType}Token`);
+      if (token) {
+        headers.Authorization = `Bearer ${token}`;
+      }
+
+      const res = await fetch("https://chatbot-ik3y.onrender.com/chat/stream", {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
+        headers,
         body: JSON.stringify({
           message: input,
           userType: currentUserType,
@@ -127,24 +134,86 @@ const Chatbot = () => {
         }),
       });
 
-      const data = await res.json();
-      
-      if (data.conversationId) {
-        setConversationId(data.conversationId);
+      // Error pages carry no events, so treat them like a failed request
+      const contentType = res.headers.get("Content-Type") || "";
+      if (!res.ok || !contentType.includes("text/event-stream")) {
+        throw new Error(`Chat request failed with status ${res.status}`);
       }
-      
-      
-      const botMessage = {
-        text: data.response,
-        sender: "bot",
-        link: data.link || null,
-        loginRequired: data.loginRequired || false,
-        actionText: data.actionText || "access this feature",
-        featureName: data.featureName || "this feature",
-        linkText: data.linkText || "Click here"
+
+      // The stream sends the link metadata first, then the reply text as it
+      // is generated, then the complete response
+      const botId = `bot_${Date.now()}`;
+      let meta = {};
+      let text = "";
+      let shown = false;
+      let finished = false;
+
+      const showBotMessage = (data) => {
+        const botMessage = {
+          id: botId,
+          text,
+          sender: "bot",
+          link: data.link || null,
+          loginRequired: data.loginRequired || false,
+          actionText: data.actionText || "access this feature",
+          featureName: data.featureName || "this feature",
+          linkText: data.linkText || "Click here"
+        };
+
+        if (!shown) {
+          shown = true;
+          setIsLoading(false);
+          setMessages(prevMessages => [...prevMessages, botMessage]);
+        } else {
+          setMessages(prevMessages =>
+            prevMessages.map(msg => (msg.id === botId ? botMessage : msg))
+          );
+        }
       };
-      
-      setMessages(prevMessages => [...prevMessages, botMessage]);
+
+      const handleEvent = (event, data) => {
+        if (event === "meta") {
+          meta = data;
+        } else if (event === "token") {
+          text += data.text;
+          showBotMessage(meta);
+        } else if (event === "done") {
+          finished = true;
+          text = data.response;
+          if (data.conversationId) {
+            setConversationId(data.conversationId);
+          }
+          showBotMessage(data);
+        }
+      };
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split("\n\n");
+        buffer = events.pop();
+
+        for (const raw of events) {
+          let event = "message";
+          let data = "";
+          for (const line of raw.split("\n")) {
+            if (line.startsWith("event: ")) event = line.slice(7);
+            else if (line.startsWith("data: ")) data += line.slice(6);
+          }
+          if (data) handleEvent(event, JSON.parse(data));
+        }
+      }
+
+      // A stream cut off before the complete response is a failed request
+      if (!finished) {
+        throw new Error("Chat stream ended before the response was complete");
+      }
     } catch (error) {
       console.error("Error sending message:", error);
       setMessages(prevMessages => [
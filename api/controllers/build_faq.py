@@ -0,0 +1,105 @@
+# Precomputes answers to common questions for every (role, feature, indicator
+# phrase) combination and writes them as JSON lines. chatbot.py loads the file
+# at startup to warm its response cache.
+#
+#   python controllers/build_faq.py                 # answers from Gemini
+#   python controllers/build_faq.py --stub          # deterministic, no model calls
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# The build must not start from a previous build's answers
+os.environ["CHATBOT_FAQ_FILE"] = ""
+
+import chatbot
+
+# Ways a question about a feature is commonly phrased. Navigation questions
+# ("where is ...") are answered locally by the chatbot and are not needed here.
+QUESTION_TEMPLATES = ["{phrase}", "what is {phrase}", "tell me about {phrase}"]
+
+
+# Function to answer a question with the model, as the chatbot would for a new
+# conversation
+def gemini_answer(prompt, intent):
+    return chatbot.clean_response(chatbot.generate_model_content(prompt).text)
+
+
+# Deterministic stand-in for the model, for tests and offline builds
+def stub_answer(prompt, intent):
+    return chatbot.local_answer(intent)
+
+
+# Function to list the questions worth precomputing, one per role and
+# normalized message
+def faq_questions():
+    questions = {}
+    for role in chatbot.role_operations:
+        for feature in chatbot.role_feature_links(role):
+            for phrase in chatbot.feature_indicators.get(feature, []):
+                for template in QUESTION_TEMPLATES:
+                    message = template.format(phrase=phrase)
+                    key = (role, chatbot.normalize_message(message))
+                    if key in questions or chatbot.is_simple_greeting(message):
+                        continue
+                    intent = chatbot.match_intent(message, role)
+                    # Skip questions the chatbot never sends to the model
+                    if intent.login_required or (
+                        chatbot.LOCAL_ANSWER_CONFIDENCE
+                        and chatbot.local_answer_confidence(message, role, intent)
+                        >= chatbot.LOCAL_ANSWER_CONFIDENCE
+                    ):
+                        continue
+                    questions[key] = {
+                        "role": role,
+                        "feature": intent.feature or feature,
+                        "phrase": phrase,
+                        "message": message,
+                        "intent": intent,
+                    }
+    return list(questions.values())
+
+
+# Function to generate every answer and write them to `path` as JSON lines
+def build_faq(path, generate=gemini_answer, workers=4):
+    questions = faq_questions()
+
+    def answer(question):
+        prompt = chatbot.build_prompt(
+            question["role"], [{"role": "user", "content": question["message"]}]
+        )
+        return generate(prompt, question["intent"])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        answers = list(executor.map(answer, questions))
+
+    written = 0
+    with open(path, "w", encoding="utf-8") as file:
+        for question, response in zip(questions, answers):
+            if not response:
+                continue
+            record = {key: question[key] for key in ("role", "feature", "phrase")}
+            record.update(message=question["message"], response=response)
+            file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            written += 1
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute chatbot answers for common questions"
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "faq_answers.jsonl"
+        ),
+    )
+    parser.add_argument("--stub", action="store_true", help="answer without the model")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    written = build_faq(
+        args.output, stub_answer if args.stub else gemini_answer, args.workers
+    )
+    print(f"Wrote {written} answers to {args.output}")
@@ -1,26 +1,434 @@
-from flask import Flask, request, jsonify
+import time
+
+# Cold start is timed from here, so it includes loading Flask and genai
+import_started = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from google import genai
 from google.genai import types
 from google.api_core import retry
+import json
+import logging
 import os
+import re
+import threading
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dotenv import load_dotenv
+from conversation_locks import ConversationLocks
+from conversation_store import create_conversation_store
+from conversation_summary import RollingSummarizer, local_summary
+from metrics import (
+    Counter,
+    Histogram,
+    LatencyCounters,
+    Trace,
+    render_sample,
+    rss_bytes,
+)
+from model_guard import (
+    AdmissionController,
+    CircuitBreaker,
+    ModelUnavailable,
+    TokenBucket,
+)
+from model_router import ModelRouter
+from model_transport import create_model_client, warm_connections
+from response_cache import (
+    ResponseCache,
+    SemanticCache,
+    hashed_ngram_embedding,
+    history_fingerprint,
+    normalize_message,
+)
+from single_flight import SingleFlight
+from student_data import (
+    StudentData,
+    mongo_database,
+    pick_student,
+    token_auth_enabled,
+    verify_token,
+)
+
+CORS_ORIGINS = ["https://emis-ebon.vercel.app"]
 
 app = Flask(__name__)
-CORS(app, origins=["https://emis-ebon.vercel.app"])
+CORS(app, origins=CORS_ORIGINS, expose_headers=["X-Trace-Id", "Server-Timing"])
 
 # Retry logic for handling API rate limits or temporary unavailability
 is_retriable = lambda e: (isinstance(e, genai.errors.APIError) and e.code in {429, 503})
-genai.models.Models.generate_content = retry.Retry(predicate=is_retriable)(
-    genai.models.Models.generate_content
-)
 
-# Initialize the GenAI client
+# The GenAI client owns an HTTP connection pool that must not be shared
+# across a fork, so each worker process creates its own on first use instead
+# of inheriting one from a preloading master
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-client = genai.Client(api_key=GOOGLE_API_KEY)
+GEMINI_MODEL = "gemini-2.0-flash"
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+client_seconds = None
+
+# Connection pool of the model client. Connections are opened before a
+# worker takes traffic, see warm_model_client.
+MODEL_TRANSPORT = {
+    "max_connections": int(os.getenv("CHATBOT_MODEL_MAX_CONNECTIONS", "100")),
+    "max_keepalive": int(os.getenv("CHATBOT_MODEL_KEEPALIVE_CONNECTIONS", "20")),
+    "keepalive_expiry": float(os.getenv("CHATBOT_MODEL_KEEPALIVE", "60")),
+    "http2": os.getenv("CHATBOT_MODEL_HTTP2", "").lower() in ("1", "true", "yes"),
+    "connect_timeout": float(os.getenv("CHATBOT_MODEL_CONNECT_TIMEOUT", "5")),
+    "read_timeout": float(os.getenv("CHATBOT_MODEL_READ_TIMEOUT", "30")),
+    "base_url": os.getenv("CHATBOT_MODEL_BASE_URL"),
+}
+WARM_CONNECTIONS = int(os.getenv("CHATBOT_MODEL_WARM_CONNECTIONS", "2"))
+warm_seconds = None
+warmed_connections = None
+
+
+# Function to get this process's GenAI client, creating it on first use
+def get_client():
+    global _client, _client_pid, client_seconds
+    if _client_pid != os.getpid():
+        with _client_lock:
+            if _client_pid != os.getpid():
+                started = time.perf_counter()
+                _client = create_model_client(GOOGLE_API_KEY, **MODEL_TRANSPORT)
+                client_seconds = time.perf_counter() - started
+                _client_pid = os.getpid()
+    return _client
+
+
+# Function to open this process's model connections before it takes traffic,
+# so the first requests do not pay for TCP and TLS setup. A failure is only
+# logged: the connections are then opened on first use instead.
+def warm_model_client():
+    global warm_seconds, warmed_connections
+    started = time.perf_counter()
+    warmed_connections = warm_connections(get_client(), GEMINI_MODEL, WARM_CONNECTIONS)
+    warm_seconds = time.perf_counter() - started
+    if warmed_connections < WARM_CONNECTIONS:
+        app.logger.warning(
+            "Opened %d of %d model connections", warmed_connections, WARM_CONNECTIONS
+        )
+    return warmed_connections
+
+
+# Prometheus metrics served at /metrics
+stage_seconds = Histogram(
+    "chatbot_stage_seconds", "Time spent in each stage of a chat turn", "stage"
+)
+response_seconds = Histogram(
+    "chatbot_response_seconds", "Time to answer a chat turn", "served_by"
+)
+model_errors = Counter(
+    "chatbot_model_errors_total",
+    "Failed model calls by HTTP status code or exception type",
+    "code",
+)
+model_retries = Counter(
+    "chatbot_model_retries_total", "Model call attempts retried after a 429 or 503"
+)
+tier_seconds = Histogram(
+    "chatbot_model_tier_seconds", "Time to answer a chat turn by model tier", "tier"
+)
+
+# Every model request, retries included, has to finish within this many seconds
+MODEL_DEADLINE = float(os.getenv("CHATBOT_MODEL_DEADLINE", "15"))
+
+# Client-side rate limit sized to the Gemini quota. It halves on 429 and
+# recovers gradually, so throttled workers queue here instead of in backoff.
+model_bucket = TokenBucket(
+    rate=float(os.getenv("CHATBOT_MODEL_RPM", "2000")) / 60,
+    burst=float(os.getenv("CHATBOT_MODEL_BURST", "50")),
+)
+
+# Stop calling the model while most recent calls fail, and answer from the
+# local routing tables instead
+model_breaker = CircuitBreaker(
+    threshold=float(os.getenv("CHATBOT_BREAKER_THRESHOLD", "0.5")),
+    window=int(os.getenv("CHATBOT_BREAKER_WINDOW", "20")),
+    min_calls=int(os.getenv("CHATBOT_BREAKER_MIN_CALLS", "10")),
+    cooldown=float(os.getenv("CHATBOT_BREAKER_COOLDOWN", "30")),
+)
+
+
+# Function to count a failed model call against the limiter and the breaker
+def record_model_error(error):
+    if isinstance(error, ModelUnavailable):
+        return
+    code = getattr(error, "code", None)
+    model_errors.inc(str(code) if code else type(error).__name__)
+    if code == 429:
+        model_bucket.throttle()
+    # Rejected requests say nothing about the health of the service
+    if isinstance(error, genai.errors.ClientError) and code != 429:
+        return
+    model_breaker.record(False)
+
+
+# Function to count a model call that is about to be retried
+def record_model_retry(error):
+    model_retries.inc()
+    if error.code == 429:
+        model_bucket.throttle()
+
+
+# Function to count a successful model call
+def record_model_success():
+    model_breaker.record(True)
+    model_bucket.recover()
+
+
+# Function to fail fast while the breaker is open
+def check_model_breaker():
+    if not model_breaker.allow():
+        raise ModelUnavailable("circuit breaker is open")
+
+
+# Function to wait for a rate limit token before a model call. Returns the
+# request options carrying the time left until the deadline.
+def acquire_model_token(deadline, config_type=types.GenerateContentConfig):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0 or not model_bucket.acquire(remaining):
+        raise ModelUnavailable("rate limit not met before the deadline")
+    return model_request_config(deadline, config_type)
+
+
+# Function to build request options whose HTTP timeout ends at the deadline
+def model_request_config(deadline, config_type=types.GenerateContentConfig):
+    remaining = max(deadline - time.monotonic(), 0.001)
+    return config_type(http_options=types.HttpOptions(timeout=int(remaining * 1000)))
+
 
-# Dictionary to store conversation history by conversation ID
-conversations = {}
+# Retries on 429 and 503 with backoff, bounded by the request deadline
+model_retry = retry.Retry(
+    predicate=is_retriable,
+    initial=0.5,
+    maximum=4,
+    timeout=MODEL_DEADLINE,
+    on_error=record_model_retry,
+)
+
+
+# Function to call the model under the deadline, rate limiter and breaker
+def generate_model_content(prompt, model=GEMINI_MODEL):
+    check_model_breaker()
+    deadline = time.monotonic() + MODEL_DEADLINE
+
+    # Every attempt, retries included, waits for its own token
+    def attempt():
+        config = acquire_model_token(deadline)
+        return get_client().models.generate_content(
+            model=model, contents=prompt, config=config
+        )
+
+    try:
+        response = model_retry(attempt)()
+    except Exception as error:
+        record_model_error(error)
+        raise
+    record_model_success()
+    return response
+
+
+# Function to stream the model's reply under the deadline, rate limiter and
+# breaker. Streams are not retried since part of the reply may have been sent.
+def stream_model_content(prompt, model=GEMINI_MODEL):
+    check_model_breaker()
+    config = acquire_model_token(time.monotonic() + MODEL_DEADLINE)
+    try:
+        for chunk in get_client().models.generate_content_stream(
+            model=model, contents=prompt, config=config
+        ):
+            yield chunk
+    except Exception as error:
+        record_model_error(error)
+        raise
+    record_model_success()
+
+
+# Admission control: at most CHATBOT_ADMISSION_SLOTS requests are answered at
+# once (0 disables it). Waiting requests are admitted staff first, then
+# teachers and parents, then guests, each with its own queue limit and
+# queue-time deadline, and shed once their queue is full or the deadline passes.
+ADMISSION_PRIORITIES = ("staff", "member", "guest")
+_role_priorities = {
+    "admin": 0,
+    "principal": 0,
+    "school": 0,
+    "districthead": 0,
+    "teacher": 1,
+    "parent": 1,
+}
+admission = None
+if int(os.getenv("CHATBOT_ADMISSION_SLOTS", "0")) > 0:
+    admission = AdmissionController(
+        int(os.getenv("CHATBOT_ADMISSION_SLOTS")),
+        max_queued=[
+            int(limit)
+            for limit in os.getenv("CHATBOT_ADMISSION_QUEUE", "64,64,16").split(",")
+        ],
+        deadlines=[
+            float(seconds)
+            for seconds in os.getenv("CHATBOT_ADMISSION_WAIT", "10,5,0.5").split(",")
+        ],
+    )
+admission_wait = Histogram(
+    "chatbot_admission_wait_seconds",
+    "Time requests waited for admission, by priority",
+    "priority",
+)
+
+# Conversation history by conversation ID, bounded in size and idle time.
+# Set CHATBOT_CONVERSATION_STORE to a sqlite:/// or redis:// URL to share it
+# between workers and instances.
+conversations = create_conversation_store(
+    os.getenv("CHATBOT_CONVERSATION_STORE", "memory"),
+    max_messages=int(os.getenv("CHATBOT_MAX_MESSAGES", "10")),
+    ttl=float(os.getenv("CHATBOT_CONVERSATION_TTL", "3600")),
+    max_conversations=int(os.getenv("CHATBOT_MAX_CONVERSATIONS", "10000")),
+    compress_after=float(os.getenv("CHATBOT_COMPRESS_AFTER", "0")),
+)
+
+# Turns of one conversation run one at a time and in arrival order, so each
+# turn sees the reply to the one before it. Unrelated conversations run in
+# parallel; the lock stripes only guard the wait queues.
+conversation_locks = ConversationLocks(
+    stripes=int(os.getenv("CHATBOT_LOCK_STRIPES", "64"))
+)
+
+
+# Function to hold a conversation for the length of a turn. Requests without
+# a conversation ID share one default conversation per role, which is not
+# worth serializing every anonymous user on.
+def hold_conversation(conversation_id):
+    if not conversation_id:
+        return nullcontext()
+    return conversation_locks.hold(conversation_id)
+
+
+# Cache for replies to repeated questions, keyed on role, normalized message
+# and optionally a fingerprint of the last few history entries
+CACHE_HISTORY_TURNS = int(os.getenv("CHATBOT_CACHE_HISTORY_TURNS", "0"))
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("CHATBOT_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("CHATBOT_CACHE_TTL", "900")),
+)
+
+
+# Embed a message with the Gemini embedding model. Embedding calls share the
+# model's deadline, rate limiter and breaker, so a cache lookup cannot keep
+# calling the API while it is failing or throttled.
+def gemini_embedding(text):
+    check_model_breaker()
+    deadline = time.monotonic() + MODEL_DEADLINE
+
+    def attempt():
+        config = acquire_model_token(deadline, types.EmbedContentConfig)
+        return get_client().models.embed_content(
+            model=EMBEDDING_MODEL, contents=text, config=config
+        )
+
+    try:
+        response = model_retry(attempt)()
+    except Exception as error:
+        record_model_error(error)
+        raise
+    record_model_success()
+    return response.embeddings[0].values
+
+
+# Optional second tier answering paraphrases of cached questions: "local" uses
+# hashed character n-grams and runs offline, "gemini" uses the embedding model
+EMBEDDING_MODEL = os.getenv("CHATBOT_EMBEDDING_MODEL", "text-embedding-004")
+SEMANTIC_CACHE = os.getenv("CHATBOT_SEMANTIC_CACHE", "")
+semantic_cache = None
+if SEMANTIC_CACHE:
+    semantic_cache = SemanticCache(
+        {"local": hashed_ngram_embedding, "gemini": gemini_embedding}[SEMANTIC_CACHE],
+        threshold=float(os.getenv("CHATBOT_SEMANTIC_THRESHOLD", "0.9")),
+        max_entries=int(os.getenv("CHATBOT_SEMANTIC_CACHE_SIZE", "1024")),
+    )
+
+# Minimum confidence for answering navigation questions without the model,
+# 0 always uses the model
+LOCAL_ANSWER_CONFIDENCE = float(os.getenv("CHATBOT_LOCAL_CONFIDENCE", "0.9"))
+
+# Short, self-contained questions go to a cheaper model, the rest to the full
+# one. A full model call slower than CHATBOT_HEDGE_AFTER seconds is also sent
+# to the cheaper model and the first answer is used (0 disables hedging).
+model_router = ModelRouter(
+    GEMINI_MODEL,
+    lite_model=os.getenv("CHATBOT_LITE_MODEL", "gemini-2.0-flash-lite"),
+    lite_max_score=int(os.getenv("CHATBOT_LITE_MAX_SCORE", "1")),
+    hedge_after=float(os.getenv("CHATBOT_HEDGE_AFTER", "0")),
+)
+hedge_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHATBOT_HEDGE_WORKERS", "32")),
+    thread_name_prefix="chatbot-hedge",
+)
+
+# Optional answers to attendance, marks and fee questions from the school's
+# records, for parents and teachers who send the token they logged in with.
+# Needs pymongo and PyJWT; figures are cached for CHATBOT_STUDENT_DATA_TTL.
+JWT_SECRET = os.getenv("JWT_SECRET")
+student_data = None
+if os.getenv("CHATBOT_STUDENT_DATA"):
+    student_data = StudentData(
+        lambda: mongo_database(
+            os.getenv("MONGO_URI"), int(os.getenv("CHATBOT_MONGO_POOL_SIZE", "10"))
+        ),
+        ttl=float(os.getenv("CHATBOT_STUDENT_DATA_TTL", "300")),
+    )
+
+# Approximate token budget for conversation history in each prompt
+HISTORY_TOKEN_BUDGET = int(os.getenv("CHATBOT_HISTORY_TOKEN_BUDGET", "1000"))
+
+
+# Function to fold older messages into a conversation summary with the model
+def gemini_summary(summary, entries):
+    transcript = "\n".join(
+        f"{entry['role'].capitalize()}: {entry['content']}" for entry in entries
+    )
+    response = generate_model_content(
+        f"""Update the summary of a chat between a user and an education management system assistant.
+Keep it under 80 words, in plain text, and keep what the user asked about.
+
+Summary so far:
+{summary or "(empty)"}
+
+New messages:
+{transcript}"""
+    )
+    return response.text.strip()
+
+
+# Optional rolling summary: messages that no longer fit the history budget, or
+# that the store is about to trim, are folded into a per-conversation summary
+# on a background thread. "local" is a deterministic offline summarizer,
+# "gemini" asks the model.
+SUMMARY_MODE = os.getenv("CHATBOT_SUMMARY", "")
+summarizer = None
+if SUMMARY_MODE:
+    summarizer = RollingSummarizer(
+        conversations,
+        {"local": local_summary, "gemini": gemini_summary}[SUMMARY_MODE],
+        max_workers=int(os.getenv("CHATBOT_SUMMARY_WORKERS", "1")),
+    )
+
+# Answers precomputed by build_faq.py, loaded into the response cache at startup
+FAQ_FILE = os.getenv(
+    "CHATBOT_FAQ_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq_answers.jsonl"),
+)
+
+# Identical questions asked at the same time share one model call
+model_flights = SingleFlight()
+
+# Latency per serving path: greeting, login, data, local, cache, coalesced,
+# model, fallback or error
+served_latency = LatencyCounters()
 
 # Role-based operations
 role_operations = {
@@ -128,45 +536,40 @@ feature_links = {
 }
 
 
-# Function to detect if user is asking about restricted features
-def needs_login(message, user_type):
-    # If user is guest or not logged in
-    if not user_type or user_type.lower() == "guest":
-        login_keywords = [
-            "attendance",
-            "marks",
-            "class",
-            "student",
-            "parent",
-            "budget",
-            "fee",
-            "leave",
-            "application",
-            "events",
-            "meeting",
-            "register",
-            "upload",
-            "create",
-            "delete",
-            "update",
-            "modify",
-            "schedule",
-            "interaction",
-            "profile",
-            "details",
-            "view",
-            "check",
-            "access",
-            "my",
-            "record",
-        ]
+# Keywords that require a logged-in user
+login_keywords = [
+    "attendance",
+    "marks",
+    "class",
+    "student",
+    "parent",
+    "budget",
+    "fee",
+    "leave",
+    "application",
+    "events",
+    "meeting",
+    "register",
+    "upload",
+    "create",
+    "delete",
+    "update",
+    "modify",
+    "schedule",
+    "interaction",
+    "profile",
+    "details",
+    "view",
+    "check",
+    "access",
+    "my",
+    "record",
+]
 
-        # Check if message contains any login keyword
-        for keyword in login_keywords:
-            if keyword.lower() in message.lower():
-                return True
 
-    return False
+# Function to detect if user is asking about restricted features
+def needs_login(message, user_type):
+    return match_intent(message, user_type).login_required
 
 
 role_indicators = {
@@ -370,38 +773,190 @@ feature_indicators = {
 }
 
 
+# Result of matching a message against the keyword tables
+Intent = namedtuple("Intent", ["login_required", "role", "feature", "link", "matched"])
+
+
+def _trie_pattern(phrases):
+    """Build a regex for the phrases factored as a trie, preferring the longest match"""
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def render(node):
+        branches = [
+            re.escape(char) + render(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # Greedy optional suffix so longer phrases win over their prefixes
+        return f"(?:{body})?" if "" in node else body
+
+    return render(trie)
+
+
+def _build_intent_matcher():
+    """Compile the keyword tables into one pattern plus a phrase -> tags lookup"""
+    roles = list(role_indicators)
+    features = list(feature_indicators)
+    tags = {}
+
+    def tag(phrase):
+        return tags.setdefault(phrase.lower(), [False, set(), set()])
+
+    for keyword in login_keywords:
+        tag(keyword)[0] = True
+    for rank, role in enumerate(roles):
+        for indicator in role_indicators[role]:
+            tag(indicator)[1].add(rank)
+    for rank, feature in enumerate(features):
+        for indicator in feature_indicators[feature]:
+            tag(indicator)[2].add(rank)
+
+    # The pattern only reports the longest phrase starting at each position, so
+    # fold the tags of every phrase into the phrases it is a prefix of
+    phrase_tags = {}
+    for phrase in tags:
+        login, role_ranks, feature_ranks = False, set(), set()
+        for other, (other_login, other_roles, other_features) in tags.items():
+            if phrase.startswith(other):
+                login = login or other_login
+                role_ranks |= other_roles
+                feature_ranks |= other_features
+        phrase_tags[phrase] = (login, frozenset(role_ranks), frozenset(feature_ranks))
+
+    pattern = re.compile(f"(?=({_trie_pattern(tags)}))")
+    return pattern, phrase_tags, roles, features
+
+
+def _build_role_feature_links():
+    """Resolve every feature link per role across both feature_links layouts"""
+    role_links = {}
+    for role in role_operations:
+        links = {}
+        for feature in feature_indicators:
+            if role in feature_links and feature in feature_links[role]:
+                links[feature] = feature_links[role][feature]
+            elif feature in feature_links and role in feature_links[feature]:
+                links[feature] = feature_links[feature][role]
+        role_links[role] = links
+    return role_links
+
+
+# Function to count the words of a feature's name that an indicator phrase
+# contains, ignoring plurals, so "parent teacher meeting" is more specific to
+# parent_teacher_meeting than to meetings
+def _phrase_specificity(phrase, feature):
+    words = {word.rstrip("s") for word in phrase.split()}
+    return sum(1 for word in feature.split("_") if word.rstrip("s") in words)
+
+
+def _build_role_phrase_index():
+    """Map each phrase the intent pattern reports to its (feature, link) per role.
+
+    A phrase that indicates several of a role's features resolves to the
+    indicator shared by the fewest of them, so "leave" beats "absent", which
+    also indicates attendance. Ties go to the longest indicator, then the
+    most specific one, then the feature listed first in feature_indicators.
+    Entries are (rank key, feature, link), so the best of several matches in
+    a message is the largest entry.
+    """
+    feature_ranks = {feature: rank for rank, feature in enumerate(feature_indicators)}
+    index = {}
+    for role, links in _role_feature_links.items():
+        owners = {}
+        for feature in links:
+            for indicator in feature_indicators[feature]:
+                owners.setdefault(indicator.lower(), set()).add(feature)
+
+        indicators = {}
+        for feature, link in links.items():
+            for indicator in feature_indicators[feature]:
+                indicator = indicator.lower()
+                key = (
+                    -len(owners[indicator]),
+                    len(indicator),
+                    _phrase_specificity(indicator, feature),
+                    -feature_ranks[feature],
+                )
+                entry = (key, feature, link)
+                indicators[indicator] = max(indicators.get(indicator, entry), entry)
+
+        # The pattern only reports the longest phrase starting at each
+        # position, which also stands for the indicators it starts with
+        role_index = {}
+        for phrase in _phrase_tags:
+            entries = [
+                entry
+                for indicator, entry in indicators.items()
+                if phrase.startswith(indicator)
+            ]
+            if entries:
+                role_index[phrase] = max(entries)
+        index[role] = role_index
+    return index
+
+
+_intent_pattern, _phrase_tags, _intent_roles, _intent_features = _build_intent_matcher()
+_role_feature_links = _build_role_feature_links()
+_role_phrase_index = _build_role_phrase_index()
+
+
+# Function to get the features a role can open, as {feature: link}
+def role_feature_links(user_type):
+    return _role_feature_links.get(user_type.lower() if user_type else "guest", {})
+
+
+# Function to match a message against all keyword tables in a single pass
+def match_intent(message, user_type=None):
+    is_guest = not user_type or user_type.lower() == "guest"
+    user_type = "guest" if is_guest else user_type.lower()
+    phrase_index = _role_phrase_index.get(user_type, {})
+
+    login = False
+    role_rank = None
+    feature_ranks = set()
+    resolved = None
+    for match in _intent_pattern.finditer(message.lower()):
+        phrase = match.group(1)
+        phrase_login, phrase_roles, phrase_features = _phrase_tags[phrase]
+        login = login or phrase_login
+        if phrase_roles:
+            best = min(phrase_roles)
+            role_rank = best if role_rank is None else min(role_rank, best)
+        feature_ranks |= phrase_features
+        entry = phrase_index.get(phrase)
+        if entry is not None and (resolved is None or entry > resolved):
+            resolved = entry
+
+    role = _intent_roles[role_rank] if role_rank is not None else None
+    matched = [_intent_features[rank] for rank in sorted(feature_ranks)]
+
+    if is_guest:
+        link = feature_links["login"].get(role, feature_links["login"]["default"])
+        feature = matched[0] if matched else None
+        return Intent(login, role, feature, link, tuple(matched))
+
+    # The least shared, then longest phrase that names one of this role's pages
+    if resolved is not None:
+        _, feature, link = resolved
+        return Intent(False, role, feature, link, tuple(matched))
+
+    link = feature_links["dashboard"].get(
+        user_type, feature_links["dashboard"]["default"]
+    )
+    return Intent(False, role, matched[0] if matched else None, link, tuple(matched))
+
+
 # Function to get appropriate feature link based on message context
 def get_feature_link(message, user_type):
-    # If user is not logged in, return login link
-    if not user_type or user_type.lower() == "guest":
-        # Try to determine which role the user might be trying to access
-        for role, indicators in role_indicators.items():
-            for indicator in indicators:
-                if indicator.lower() in message.lower():
-                    return feature_links["login"].get(
-                        role, feature_links["login"]["default"]
-                    )
-
-        # Default login link if no specific role is detected
-        return feature_links["login"]["default"]
-
-    # For logged-in users, detect which feature they're asking about
-    user_type = user_type.lower()
-
-    # Check which feature the user is asking about
-    for feature, indicators in feature_indicators.items():
-        for indicator in indicators:
-            if indicator.lower() in message.lower():
-                # Check if this feature is available for the user's role
-                if user_type in feature_links and feature in feature_links[user_type]:
-                    return feature_links[user_type][feature]
-                elif feature in feature_links and user_type in feature_links[feature]:
-                    return feature_links[feature][user_type]
-
-    # If no specific feature is detected, return the dashboard link for this user type
-    if user_type in feature_links["dashboard"]:
-        return feature_links["dashboard"][user_type]
-    return feature_links["dashboard"]["default"]
+    return match_intent(message, user_type).link
 
 
 # Check if message is a simple greeting
@@ -441,175 +996,912 @@ def get_greeting_response(user_type):
     )
 
 
+# Patterns for clean_response, compiled once. The ones run over every reply
+# start with a literal so the regex engine can skip ahead to candidates, and
+# none can backtrack past a newline or over text it already rejected, so
+# cleaning stays linear in the length of the reply even on adversarial output.
+_bold_span = re.compile(r"\*\*[^\n]*?\*\*(:?)")
+_reasoning_markers = ("Here's my reasoning and response:", "As a helpful AI assistant")
+_reasoning_patterns = tuple(
+    (marker, re.compile(re.escape(marker) + r"\W*(?=\w)"))
+    for marker in _reasoning_markers
+)
+_blank_lines = re.compile(r"\n\s*\n")
+_word = re.compile(r"\w")
+
+
+# Function to find where a numbered heading ("2", "2." or "2." and whitespace)
+# ending at `end` starts, looking no further back than `floor`. Returns -1 if
+# the text does not end with one.
+def _heading_start(text, end, floor=0):
+    start = end
+    while start > floor and text[start - 1].isspace():
+        start -= 1
+    if start > floor and text[start - 1] == ".":
+        start -= 1
+    elif start < end:
+        return -1
+    digits = start
+    while digits > floor and text[digits - 1].isdecimal():
+        digits -= 1
+    return digits if digits < start else -1
+
+
 def clean_response(response_text):
     """Clean up the response text to remove markdown and reasoning patterns"""
     # Remove markdown code blocks
     response_text = response_text.replace("```", "")
 
-    # Remove numbered reasoning steps
-    import re
+    return _remove_reasoning(response_text).strip()
 
-    response_text = re.sub(r"\d+\.\s+\*\*.*?\*\*:", "", response_text)
-    response_text = re.sub(r"\*\*.*?\*\*", "", response_text)
 
-    # Remove "Here's my reasoning and response:" pattern
-    response_text = re.sub(
-        r"Here's my reasoning and response:.*?(?=\w)",
-        "",
-        response_text,
-        flags=re.DOTALL,
-    )
+def _remove_bold(response_text):
+    # Bold spans, and numbered reasoning steps ("1. **Step**:") in the same pass
+    if "**" not in response_text:
+        return response_text
+    # Text between spans at even indexes, the colon after each span at odd ones
+    pieces = _bold_span.split(response_text)
+    for index in range(1, len(pieces), 2):
+        if not pieces[index]:
+            continue
+        before = pieces[index - 1]
+        head = before.rstrip()
+        if len(head) == len(before) or not head.endswith("."):
+            continue
+        number = len(head) - 1
+        while number and head[number - 1].isdecimal():
+            number -= 1
+        if number < len(head) - 1:
+            pieces[index - 1] = head[:number]
+            pieces[index] = ""
+    return "".join(pieces)
+
+
+def _remove_reasoning(response_text):
+    response_text = _remove_bold(response_text)
+
+    # Remove reasoning phrases up to the next word
+    for marker, pattern in _reasoning_patterns:
+        if marker in response_text:
+            response_text = pattern.sub("", response_text)
+
+    # Replace multiple newlines with a single one
+    return _blank_lines.sub("\n", response_text)
 
-    # Remove any explicit reasoning patterns
-    response_text = re.sub(
-        r"As a helpful AI assistant.*?(?=\w)", "", response_text, flags=re.DOTALL
+
+class ResponseCleaner:
+    """Incremental clean_response for streamed model output.
+
+    Text is held back only while a pattern could still match across the next
+    chunk: trailing backticks, whitespace, bold markers on the current line,
+    numbered headings and reasoning phrases that are not finished yet. At
+    most `max_held` characters are held; past that the text is cleaned as it
+    stands, so a reply that never closes a pattern still costs linear time.
+    Searches for open patterns only look at the text that may be held, so
+    each chunk costs time linear in its length plus `max_held`.
+    """
+
+    def __init__(self, max_held=2048):
+        self.max_held = max_held
+        self._raw = ""
+        self._pending = ""
+        self._started = False
+
+    def feed(self, chunk):
+        self._raw += chunk
+        held = len(self._raw) - len(self._raw.rstrip("`"))
+        ready = self._raw[: len(self._raw) - held]
+        self._raw = self._raw[len(self._raw) - held :]
+        self._pending += ready.replace("```", "")
+
+        # A finished reasoning phrase is removed with the whitespace after it
+        # once a word arrives, so keep holding the phrase and drop whitespace
+        # that does not fit rather than letting the phrase go uncleaned
+        stripped = len(self._pending.rstrip())
+        for marker in _reasoning_markers:
+            if self._pending.endswith(marker, 0, stripped):
+                start = stripped - len(marker)
+                self._pending = self._pending[: start + self.max_held]
+
+        floor = len(self._pending) - self.max_held
+        cut = max(self._safe_cut(self._pending, floor), floor)
+        if not cut:
+            return ""
+        segment = _remove_reasoning(self._pending[:cut])
+        # Whitespace left at the end may still collapse with the next chunk or
+        # be stripped at the end of the reply, unless there is too much to hold
+        text = segment.rstrip()
+        if len(segment) - len(text) > self.max_held:
+            text = segment
+        self._pending = segment[len(text) :] + self._pending[cut:]
+        return self._emit(text)
+
+    def flush(self):
+        text = _remove_reasoning((self._pending + self._raw).replace("```", ""))
+        self._pending = self._raw = ""
+        return self._emit(text.rstrip())
+
+    def _emit(self, text):
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+    @staticmethod
+    def _safe_cut(text, floor=0):
+        # Searches never look before floor, where the text is let go anyway,
+        # and only the steps that can expose an earlier open pattern repeat
+        floor = max(floor, 0)
+        cut = len(text.rstrip())
+        # A reasoning phrase still arriving can only be at the end of the text
+        for marker in _reasoning_markers:
+            for size in range(min(len(marker) - 1, len(text)), 0, -1):
+                if marker.startswith(text[len(text) - size :]):
+                    cut = min(cut, len(text) - size)
+                    break
+        last_line = text.rfind("\n") + 1
+        first = True
+        while cut > floor:
+            settled = cut
+
+            # Bold and numbered-heading patterns stay on one line, except that
+            # a heading number may sit on the line before its bold title
+            line_start = max(text.rfind("\n", floor, cut) + 1, floor)
+            heading = _heading_start(text, line_start, floor)
+            if heading != -1:
+                line_start = heading
+            # Bold spans pair up left to right, so a closed span is final once
+            # the character after it has arrived and is not a heading colon.
+            # On a finished line every span is known, so the cut only has to
+            # move out of one it splits.
+            unfinished = cut >= last_line
+            closed = line_start
+            end = cut if unfinished else text.find("\n", cut)
+            for match in _bold_span.finditer(text, line_start, end):
+                if match.start() >= cut:
+                    break
+                if match.end() > cut or (
+                    match.end() == cut and text[cut : cut + 1] in ("", ":")
+                ):
+                    cut = match.start()
+                    break
+                closed = match.end()
+            # Only "**" on the line still arriving can open a span, and a
+            # single "*" at its end may become one
+            star = text.find("**", closed, cut) if unfinished else -1
+            if star != -1:
+                cut = star
+            elif unfinished and cut > closed and text[cut - 1] == "*":
+                cut -= 1
+            # Only the last number before a bold span is a heading, so text
+            # before a heading or a reasoning phrase needs no second look
+            if cut != settled or first:
+                heading = _heading_start(text, cut, floor)
+                if heading != -1:
+                    cut = heading
+
+            # Finished reasoning phrases, from the last one back. A phrase is
+            # removed up to the next word left after bold removal, so one with
+            # no word before the cut is held. The phrases before one that is
+            # not have its words after them, unless a bold span could open
+            # before it on its line.
+            found = {
+                marker: text.rfind(marker, floor, cut) for marker in _reasoning_markers
+            }
+            while True:
+                marker = max(found, key=found.get)
+                start = found[marker]
+                if start == -1:
+                    break
+                found[marker] = text.rfind(marker, floor, start)
+                tail = _remove_bold(text[start + len(marker) : cut])
+                if not _word.search(tail):
+                    cut = start
+                elif text.find("**", text.rfind("\n", floor, start) + 1, start) == -1:
+                    break
+
+            if cut == settled:
+                break
+            first = False
+        return cut
+
+
+# State of one chat turn between reading the history and storing the reply
+class ChatTurn:
+    __slots__ = (
+        "conversation_id",
+        "user_entry",
+        "prompt",
+        "response",
+        "source",
+        "cache_key",
+        "embedding",
+        "intent",
+        "tier",
+        "trace",
+        "started",
     )
 
-    # Replace multiple newlines with a single one
-    response_text = re.sub(r"\n\s*\n", "\n", response_text)
+    def __init__(self, conversation_id, user_entry):
+        self.conversation_id = conversation_id
+        self.user_entry = user_entry
+        self.prompt = None
+        self.response = None
+        # greeting, login, data, local, cache, coalesced, model, fallback or error
+        self.source = None
+        self.cache_key = None
+        self.embedding = None
+        self.intent = None
+        # Model tier that answered: local, lite or full
+        self.tier = None
+        self.trace = None
+        self.started = time.perf_counter()
+
+
+# Questions asking where something is rather than about its content
+_navigation_pattern = re.compile(
+    r"\b(where|how (do|can|would) i|how to|open|go to|take me|navigate|link|"
+    r"page|find|show me|get to|access)\b"
+)
 
-    return response_text.strip()
 
+# Function to score how safely a message can be answered with its link alone
+def local_answer_confidence(message, user_type, intent):
+    role = user_type.lower() if user_type else "guest"
+    if intent.login_required or intent.feature not in _role_feature_links.get(role, {}):
+        return 0.0
 
-# Function to call Google Gemini 2.0 Flash model API with memory
-def gemini_flash_model_response(message, user_type=None, conversation_id=None):
-    # Get or create conversation history for this conversation ID
-    if not conversation_id:
-        conversation_id = f"default_{user_type}"
+    lowered = message.lower()
+    confidence = 0.5
+    if _navigation_pattern.search(lowered):
+        confidence += 0.3
+    if len(intent.matched) == 1:
+        confidence += 0.1
+    if len(lowered.split()) <= 12:
+        confidence += 0.1
+    return confidence
 
-    if conversation_id not in conversations:
-        conversations[conversation_id] = []
 
-    chat_history = conversations[conversation_id]
+# Function to build the templated reply for a navigation question
+def local_answer(intent):
+    page = intent.feature.replace("_", " ").title()
+    return f"You'll find that on your {page} page. Use the link below to open it."
 
-    # Special case for simple greetings
-    if is_simple_greeting(message):
-        response_text = get_greeting_response(user_type)
 
-        chat_history.append({"role": "user", "content": message})
-        chat_history.append({"role": "assistant", "content": response_text})
-        return response_text
+# Questions asking for a figure rather than where to find it
+_data_question_pattern = re.compile(
+    r"\b(what|what's|whats|how many|how much|how is|how's|percentage|percent|"
+    r"score|scored|got|pending|due|owe|paid|latest|recent|last|this month|so far)\b"
+)
 
-    # Add user message to history
-    chat_history.append({"role": "user", "content": message})
+# Figures each role may read from the records, as on their dashboards
+_data_topics = {
+    "parent": ("attendance", "marks", "fees"),
+    "teacher": ("attendance", "marks"),
+}
 
-    # If chat history exceeds limit, trim it
-    if len(chat_history) > 10:
-        # Keep the first message (could be system) and the last 9 messages
-        chat_history = chat_history[:1] + chat_history[-9:]
 
-    # Check if user is asking about login functionality
-    login_required = needs_login(message, user_type)
-    if login_required and (not user_type or user_type.lower() == "guest"):
-        login_response = "You need to log in to access this feature. "
-
-        # Check if asking about a specific role functionality
-        if "as a teacher" in message.lower() or "teacher functions" in message.lower():
-            login_response += "Please log in with your teacher credentials to access teacher features."
-        elif "as a parent" in message.lower() or "parent functions" in message.lower():
-            login_response += "Please log in with your parent credentials to check your child's information."
-        elif "as admin" in message.lower() or "admin functions" in message.lower():
-            login_response += "Please log in with your admin credentials to access administration features."
-        elif (
-            "as principal" in message.lower()
-            or "principal functions" in message.lower()
-        ):
-            login_response += "Please log in with your principal credentials to access school management features."
-        else:
-            login_response += "Please log in to access this feature."
+# Function to answer a question about a student's attendance, marks or fees
+# from their records. Returns None when the caller, the question or the
+# records cannot answer it.
+def data_answer(message, intent, identity):
+    if intent.feature not in _data_topics.get(identity.role, ()):
+        return None
+    if not _data_question_pattern.search(message.lower()):
+        return None
+
+    student = pick_student(message, student_data.students(identity) or [])
+    if student is None:
+        return None
+    student_id = student["student_id"]
+    name = student.get("name") or student_id
+
+    if intent.feature == "attendance":
+        attendance = student_data.attendance(student_id)
+        if attendance is None:
+            return None
+        lines = []
+        for period, label in (("month", "this month"), ("overall", "overall")):
+            present, total = attendance[period]
+            if total:
+                lines.append(
+                    f"{name}'s attendance {label} is {round(100 * present / total)}% "
+                    f"({present} of {total} days present)."
+                )
+        return " ".join(lines) or f"No attendance has been recorded for {name} yet."
+
+    if intent.feature == "marks":
+        marks = student_data.marks(student_id)
+        if marks is None:
+            return None
+        if not marks:
+            return f"No marks have been recorded for {name} yet."
+        results = ", ".join(
+            f"{mark['subject']} {mark['value']}/{mark['maxMarks']} ({mark['examType']})"
+            for mark in marks
+        )
+        return f"{name}'s latest marks: {results}."
+
+    fees = student_data.fees(student_id)
+    if fees is None:
+        return None
+    if not fees["pending"]:
+        return f"{name} has no pending fee payments."
+    return (
+        f"{name} has {fees['pending']} pending fee payment"
+        f"{'s' if fees['pending'] > 1 else ''} of {fees['amount']:g} in total "
+        f"({', '.join(fees['feeTypes'])})."
+    )
+
+
+# Function to answer without the model while it is unavailable
+def fallback_answer(turn):
+    turn.source = "fallback"
+    return busy_answer(turn.intent)
+
+
+# Function to build the reply given without the model while it is busy
+def busy_answer(intent):
+    if intent is not None and intent.feature:
+        return local_answer(intent)
+    return "The assistant is busy right now. Use the link below to open your dashboard, or try again in a moment."
+
+
+# Follow-up questions that only make sense with the earlier turns
+_follow_up_pattern = re.compile(
+    r"\b(it|that|this|those|these|them|they|he|she|his|her|above|previous|"
+    r"earlier|again|else|more)\b|^\s*(and|also|what about|how about|why)\b"
+)
 
-        chat_history.append({"role": "assistant", "content": login_response})
-        return login_response
 
-    # Prepare full conversation history
-    conversation = "\n".join(
-        [f"{entry['role'].capitalize()}: {entry['content']}" for entry in chat_history]
+# Function to build the response cache key, or None when the cache is skipped
+def response_cache_key(message, user_type, history):
+    if response_cache.max_entries <= 0:
+        return None
+    if (
+        history
+        and not CACHE_HISTORY_TURNS
+        and _follow_up_pattern.search(message.lower())
+    ):
+        response_cache.bypass()
+        return None
+    role = user_type.lower() if user_type else "guest"
+    return (
+        role,
+        normalize_message(message),
+        history_fingerprint(history, CACHE_HISTORY_TURNS),
     )
 
-    # Prompt construction with role-specific context - UPDATED PROMPT
-    prompt = f"""
-    You are an AI assistant for an education management system. The user is a {user_type or 'guest'}.
-    
-    Here's what {user_type or 'guest'} users can do in this system:
-    {role_operations.get(user_type.lower(), ['Limited access until login'])}
-    
-    IMPORTANT INSTRUCTIONS:
-    1. NEVER mention searching databases, fetching data, or retrieving information.
-    2. Instead, directly tell users what they can or cannot access based on their role.
-    3. If a user asks about accessing information they don't have permission for, simply state they don't have access to that information due to their role.
-    4. If a user asks about a specific person or data, don't say you're "fetching" or "searching" - just explain what they can see based on their permissions.
-    5. If a guest user asks about features requiring login, suggest they log in to access those features.
-    
-    Give ONLY the direct response to the user's query without any explanation of your reasoning.
-    Keep responses concise (2-3 sentences maximum) and natural sounding.
-    DO NOT include markdown formatting, numbered steps, or reasoning steps in your response.
-    
-    Conversation:
-    {conversation}
-    """
 
+# Function to pre-warm the response cache with answers written by build_faq.py
+def load_faq_answers(path):
+    if not path or not os.path.exists(path):
+        return 0
+    loaded = 0
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            key = response_cache_key(record["message"], record["role"], [])
+            if key is not None:
+                response_cache.warm(key, record["response"])
+                loaded += 1
+    return loaded
+
+
+# A cold instance serves common questions without waiting on the model
+faq_answers_loaded = load_faq_answers(FAQ_FILE)
+
+
+# Function to look a turn up in the exact cache, then the semantic cache
+def lookup_cached_response(turn, message):
+    if turn.cache_key is None:
+        return None
+    cached = response_cache.get(turn.cache_key)
+    if cached is not None or semantic_cache is None:
+        return cached
+
+    # Near duplicates are only matched on turns that are not keyed on history
+    fingerprint = turn.cache_key[2]
+    if fingerprint:
+        return None
+    # An open breaker, a missing rate limit token or a failed embedding only
+    # skips this tier; the turn still goes to the model
     try:
-        # Send the prompt to Gemini 2.0 Flash model
-        response = client.models.generate_content(
-            model="gemini-2.0-flash", contents=prompt
+        turn.embedding = semantic_cache.vector(message)
+    except Exception:
+        return None
+    return semantic_cache.get(semantic_bucket(turn), turn.embedding)
+
+
+# Function to pick a turn's semantic cache bucket. Paraphrases that differ only
+# in the feature they ask about embed closely, so each feature of a role keeps
+# its own bucket.
+def semantic_bucket(turn):
+    return turn.cache_key[0], turn.intent.feature
+
+
+# Function to remember a model reply in both cache tiers
+def store_cached_response(turn):
+    if turn.cache_key is None:
+        return
+    response_cache.put(turn.cache_key, turn.response)
+    if turn.embedding is not None:
+        semantic_cache.put(semantic_bucket(turn), turn.embedding, turn.response)
+
+
+# Prompt instructions, rendered once per role at startup
+PROMPT_TEMPLATE = """You are an AI assistant for an education management system. The user is a {user_type}.
+
+Here's what {user_type} users can do in this system:
+{operations}
+
+IMPORTANT INSTRUCTIONS:
+1. NEVER mention searching databases, fetching data, or retrieving information.
+2. Instead, directly tell users what they can or cannot access based on their role.
+3. If a user asks about accessing information they don't have permission for, simply state they don't have access to that information due to their role.
+4. If a user asks about a specific person or data, don't say you're "fetching" or "searching" - just explain what they can see based on their permissions.
+5. If a guest user asks about features requiring login, suggest they log in to access those features.
+
+Give ONLY the direct response to the user's query without any explanation of your reasoning.
+Keep responses concise (2-3 sentences maximum) and natural sounding.
+DO NOT include markdown formatting, numbered steps, or reasoning steps in your response.
+
+Conversation:
+"""
+
+
+def _render_prompt_header(user_type):
+    operations = role_operations.get(user_type, ["Limited access until login"])
+    return PROMPT_TEMPLATE.format(
+        user_type=user_type,
+        operations="\n".join(f"- {operation}" for operation in operations),
+    )
+
+
+_prompt_headers = {
+    role: _render_prompt_header(role) for role in [*role_operations, "guest"]
+}
+
+
+# Function to get the static prompt header for a role
+def prompt_header(user_type):
+    role = user_type.lower() if user_type else "guest"
+    header = _prompt_headers.get(role)
+    return header if header is not None else _render_prompt_header(role)
+
+
+# Rough token count, about four characters per token for English text
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+# Function to keep the newest history entries that fit a token budget. The
+# newest entry (the current message) is always kept.
+def history_window(entries, budget):
+    window = []
+    for entry in reversed(entries):
+        # Two extra tokens cover the role label and the line break
+        cost = estimate_tokens(entry["content"]) + 2
+        if window and cost > budget:
+            break
+        budget -= cost
+        window.append(entry)
+    window.reverse()
+    return window
+
+
+# Function to render the prompt for a role, history window and optional summary
+def build_prompt(user_type, window, summary=""):
+    lines = [f"Summary of earlier messages: {summary}"] if summary else []
+    lines.extend(
+        f"{entry['role'].capitalize()}: {entry['content']}" for entry in window
+    )
+    return prompt_header(user_type) + "\n".join(lines)
+
+
+# Function to build the reply asking the user to log in, naming the
+# credentials to use when the message mentions a role
+def login_reply(message):
+    login_response = "You need to log in to access this feature. "
+
+    # Check if asking about a specific role functionality
+    if "as a teacher" in message.lower() or "teacher functions" in message.lower():
+        login_response += (
+            "Please log in with your teacher credentials to access teacher features."
         )
+    elif "as a parent" in message.lower() or "parent functions" in message.lower():
+        login_response += "Please log in with your parent credentials to check your child's information."
+    elif "as admin" in message.lower() or "admin functions" in message.lower():
+        login_response += "Please log in with your admin credentials to access administration features."
+    elif "as principal" in message.lower() or "principal functions" in message.lower():
+        login_response += "Please log in with your principal credentials to access school management features."
+    else:
+        login_response += "Please log in to access this feature."
+    return login_response
+
+
+# Function to answer locally or build the model prompt for a turn
+def prepare_turn(
+    message,
+    user_type=None,
+    conversation_id=None,
+    intent=None,
+    trace=None,
+    identity=None,
+):
+    # Get or create conversation history for this conversation ID
+    if not conversation_id:
+        conversation_id = f"default_{user_type}"
 
-        # Clean the response text
-        response_text = clean_response(response.text)
+    # The user message is stored together with the reply in a single write
+    turn = ChatTurn(conversation_id, {"role": "user", "content": message})
+    turn.trace = trace if trace is not None else Trace()
 
-        chat_history.append({"role": "assistant", "content": response_text})
-        return response_text
-    except Exception as e:
-        return f"I'm having trouble processing your request. Please try again."
+    # Special case for simple greetings
+    if is_simple_greeting(message):
+        turn.response = get_greeting_response(user_type)
+        turn.source = "greeting"
+        return turn
 
+    # Check if user is asking about login functionality
+    if intent is None:
+        started = time.perf_counter()
+        intent = match_intent(message, user_type)
+        record_stage(turn.trace, "route", started)
+    turn.intent = intent
+    if intent.login_required:
+        turn.response = login_reply(message)
+        turn.source = "login"
+        return turn
+
+    # Figures about the caller's students are read from their records
+    if student_data is not None and identity is not None:
+        started = time.perf_counter()
+        try:
+            turn.response = data_answer(message, intent, identity)
+        except Exception as error:
+            app.logger.warning(
+                "Student data lookup failed (trace %s): %s: %s",
+                turn.trace.trace_id,
+                type(error).__name__,
+                error,
+            )
+        record_stage(turn.trace, "data", started)
+        if turn.response is not None:
+            turn.source = "data"
+            return turn
+
+    # Navigation questions with a clear feature match are answered locally
+    if (
+        LOCAL_ANSWER_CONFIDENCE
+        and local_answer_confidence(message, user_type, intent)
+        >= LOCAL_ANSWER_CONFIDENCE
+    ):
+        turn.response = local_answer(intent)
+        turn.source = "local"
+        turn.tier = "local"
+        return turn
+
+    # The store returns only the most recent messages
+    started = time.perf_counter()
+    history = conversations.history(conversation_id)
+    started = record_stage(turn.trace, "history", started)
+
+    # Repeated questions are answered from the cache
+    turn.cache_key = response_cache_key(message, user_type, history)
+    cached = lookup_cached_response(turn, message)
+    started = record_stage(turn.trace, "cache", started)
+    if cached is not None:
+        turn.response = cached
+        turn.source = "cache"
+        return turn
+
+    # Static instructions come from the role's precomputed header, and only
+    # the newest turns that fit the token budget are rendered
+    entries = history + [turn.user_entry]
+    summary = conversations.summary(conversation_id) if summarizer else ""
+    budget = HISTORY_TOKEN_BUDGET - (estimate_tokens(summary) if summary else 0)
+    window = history_window(entries, budget)
+    turn.prompt = build_prompt(user_type, window, summary)
+    turn.tier = model_router.route(
+        len(message.split()),
+        len(history),
+        bool(_follow_up_pattern.search(message.lower())),
+        intent.feature is not None,
+    )
+    record_stage(turn.trace, "prompt", started)
+
+    if summarizer:
+        # Fold what no longer fits, and start a turn before the store would
+        # trim messages so a fold that loses a race is retried in time
+        fold = max(
+            len(entries) - len(window),
+            len(history) + 4 - conversations.max_messages,
+        )
+        if fold > 0:
+            summarizer.submit(conversation_id, history[:fold])
 
-# Generate response based on user role and message
-def generate_response(message, user_type=None, conversation_id=None):
-    if not message:
-        return {"response": "Please provide a message.", "link": "/help"}
+    return turn
 
-    # Get the appropriate feature link based on message content
-    feature_link = get_feature_link(message, user_type)
 
-    # Check if this is a login-required situation
-    login_required = needs_login(message, user_type)
+# Function to store a finished turn and return the reply text
+def finish_turn(turn):
+    started = time.perf_counter()
+    if turn.response is None:
+        conversations.append(turn.conversation_id, turn.user_entry)
+        turn.response = "I'm having trouble processing your request. Please try again."
+        turn.source = "error"
+    else:
+        if turn.source is None:
+            turn.source = "model"
+            store_cached_response(turn)
+
+        conversations.append(
+            turn.conversation_id,
+            turn.user_entry,
+            {"role": "assistant", "content": turn.response},
+        )
+
+    record_stage(turn.trace, "store", started)
+    elapsed = time.perf_counter() - turn.started
+    served_latency.record(turn.source, elapsed)
+    response_seconds.observe(turn.source, elapsed)
+    if turn.source in ("local", "model"):
+        model_router.record(turn.tier, elapsed)
+        tier_seconds.observe(turn.tier, elapsed)
+    return turn.response
+
+
+# Function to wait for an identical question already being sent to the model.
+# Returns whether this turn should call the model itself, and must then pass
+# its reply to model_flights.finish().
+def join_model_call(turn):
+    flight, leader = model_flights.join(turn.cache_key)
+    if not leader:
+        started = time.perf_counter()
+        turn.response = flight.result()
+        turn.source = "coalesced"
+        record_stage(turn.trace, "coalesce", started)
+    return leader
+
+
+# Function to record how long a stage of a turn took, from `started` until now.
+# Returns the current time so the next stage can start from it.
+def record_stage(trace, stage, started):
+    now = time.perf_counter()
+    trace.timings[stage] = trace.timings.get(stage, 0.0) + now - started
+    stage_seconds.observe(stage, now - started)
+    return now
+
+
+# Function to log a failed model call; the error itself is counted by
+# record_model_error
+def log_model_error(turn, error):
+    app.logger.warning(
+        "Model call failed (trace %s): %s: %s",
+        turn.trace.trace_id,
+        type(error).__name__,
+        error,
+    )
+
 
-    # Use Gemini model to analyze the query
-    model_response = gemini_flash_model_response(message, user_type, conversation_id)
+# Function to call the model on the turn's tier. When the call is still running
+# after the hedging delay, the prompt is also sent to the hedge tier and the
+# first successful reply is used; the slower call finishes in the background.
+def call_routed_model(turn):
+    hedge = model_router.hedge_tier(turn.tier)
+    if hedge is None:
+        return generate_model_content(turn.prompt, model_router.model(turn.tier))
 
+    primary = hedge_executor.submit(
+        generate_model_content, turn.prompt, model_router.model(turn.tier)
+    )
+    calls = {primary: turn.tier}
+    done, pending = wait(calls, timeout=model_router.hedge_after)
+    if not done:
+        hedged = hedge_executor.submit(
+            generate_model_content, turn.prompt, model_router.model(hedge)
+        )
+        calls[hedged] = hedge
+        pending.add(hedged)
+        model_router.record_hedge()
+
+    error = None
+    while True:
+        for call in done:
+            if call.exception() is None:
+                if call is not primary:
+                    model_router.record_hedge_win()
+                turn.tier = calls[call]
+                return call.result()
+            error = error or call.exception()
+        if not pending:
+            raise error
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+
+# Function to run a turn end to end, calling the model only when needed
+def run_turn(
+    message,
+    user_type=None,
+    conversation_id=None,
+    intent=None,
+    trace=None,
+    identity=None,
+):
+    with hold_conversation(conversation_id):
+        turn = prepare_turn(
+            message, user_type, conversation_id, intent, trace, identity
+        )
+        if turn.response is None and join_model_call(turn):
+            try:
+                # Send the prompt to the Gemini model picked by the router
+                started = time.perf_counter()
+                response = call_routed_model(turn)
+                started = record_stage(turn.trace, "model", started)
+
+                # Clean the response text
+                turn.response = clean_response(response.text)
+                record_stage(turn.trace, "clean", started)
+            except ModelUnavailable:
+                turn.response = fallback_answer(turn)
+            except Exception as error:
+                log_model_error(turn, error)
+            finally:
+                model_flights.finish(turn.cache_key, turn.response)
+        finish_turn(turn)
+    return turn
+
+
+# Function to answer with the Gemini model picked by the router, with memory
+def gemini_flash_model_response(
+    message, user_type=None, conversation_id=None, intent=None
+):
+    return run_turn(message, user_type, conversation_id, intent).response
+
+
+# Function to build the link and display fields for a matched intent
+def describe_intent(intent):
     # Determine feature name for display
     feature_name = "this feature"
     link_text = "Click here"  # Default link text
 
-    for feature, indicators in feature_indicators.items():
-        for indicator in indicators:
-            if indicator.lower() in message.lower():
-                feature_name = feature.replace("_", " ")
-                link_text = f"Go to {feature_name.title()}"
-                break
+    if intent.feature:
+        feature_name = intent.feature.replace("_", " ")
+        link_text = f"Go to {feature_name.title()}"
 
     # For login required cases
-    if login_required and (not user_type or user_type.lower() == "guest"):
+    if intent.login_required:
         action_text = f"Log in to access {feature_name}"
         link_text = "Log in"
     else:
         action_text = f"View {feature_name}"
 
     return {
-        "response": model_response,
-        "link": feature_link,
-        "conversationId": conversation_id,
-        "loginRequired": login_required
-        and (not user_type or user_type.lower() == "guest"),
+        "link": intent.link,
+        "loginRequired": intent.login_required,
         "actionText": action_text,
         "featureName": feature_name,
         "linkText": link_text,  # Add link text for frontend
     }
 
 
-@app.route("/chat", methods=["POST"])
-def chat():
-    data = request.get_json()
+# Generate response based on user role and message
+def generate_response(
+    message,
+    user_type=None,
+    conversation_id=None,
+    intent=None,
+    trace=None,
+    identity=None,
+):
+    if not message:
+        return {"response": "Please provide a message.", "link": "/help"}
+
+    # Resolve login requirement, feature and link in one pass over the message
+    received = time.perf_counter()
+    if trace is None:
+        trace = Trace()
+    if intent is None:
+        intent = match_intent(message, user_type)
+        record_stage(trace, "route", received)
+
+    # Under overload, requests are shed before any work is done for them
+    with admission_slot(user_type, identity) as priority:
+        if priority is None:
+            return shed_response(message, user_type, conversation_id, intent, received)
+
+        # Answer locally or with the Gemini model
+        turn = run_turn(message, user_type, conversation_id, intent, trace, identity)
+
+    return {
+        "response": turn.response,
+        "conversationId": conversation_id,
+        "servedBy": turn.source,
+        **describe_intent(intent),
+    }
+
+
+# Generate a response as (event, data) pairs: the link metadata first, then the
+# reply text as it streams in, then the complete payload
+def generate_response_stream(
+    message, user_type=None, conversation_id=None, trace=None, identity=None
+):
+    if not message:
+        response_text = "Please provide a message."
+        yield "token", {"text": response_text}
+        yield "done", {"response": response_text, "link": "/help"}
+        return
+
+    # Routing is local, so the link is known before the model starts
+    received = time.perf_counter()
+    if trace is None:
+        trace = Trace()
+    intent = match_intent(message, user_type)
+    record_stage(trace, "route", received)
+    response_data = {"conversationId": conversation_id, **describe_intent(intent)}
+    yield "meta", response_data
+
+    with admission_slot(user_type, identity) as priority:
+        if priority is None:
+            response_data = shed_response(
+                message, user_type, conversation_id, intent, received
+            )
+            yield "token", {"text": response_data["response"]}
+            yield "done", response_data
+            return
+
+        with hold_conversation(conversation_id):
+            turn = prepare_turn(
+                message, user_type, conversation_id, intent, trace, identity
+            )
+            leader = turn.response is None and join_model_call(turn)
+            if turn.response is not None:
+                yield "token", {"text": turn.response}
+            elif leader:
+                cleaner = ResponseCleaner()
+                parts = []
+                started = time.perf_counter()
+                try:
+                    # Streams are not hedged, since part of the reply may have been sent
+                    for chunk in stream_model_content(
+                        turn.prompt, model_router.model(turn.tier)
+                    ):
+                        text = cleaner.feed(chunk.text or "")
+                        if text:
+                            parts.append(text)
+                            yield "token", {"text": text}
+                    text = cleaner.flush()
+                    if text:
+                        parts.append(text)
+                        yield "token", {"text": text}
+                    turn.response = "".join(parts)
+                except ModelUnavailable:
+                    turn.response = fallback_answer(turn)
+                    yield "token", {"text": turn.response}
+                except Exception as error:
+                    log_model_error(turn, error)
+                finally:
+                    # Also runs when the client disconnects, so followers never hang
+                    model_flights.finish(turn.cache_key, turn.response)
+                    # Streaming and cleaning overlap, so they are timed as one stage
+                    record_stage(turn.trace, "model", started)
+
+            # On failure the final response replaces any partial text already sent
+            response_text = finish_turn(turn)
+    yield "done", {**response_data, "response": response_text, "servedBy": turn.source}
+
+
+# Format one server-sent event
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Read the chat fields from a request body
+def parse_chat_request(data):
+    data = {} if data is None else data
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object")
     message = data.get("message", "")
     user_type = data.get("userType", "guest")
     conversation_id = data.get("conversationId")
@@ -618,25 +1910,436 @@ def chat():
     if not user_type or user_type == "":
         user_type = "guest"
 
+    return message, user_type, conversation_id
+
+
+# Batches share one bounded pool, so a large batch cannot take over the server
+BATCH_MAX_ITEMS = int(os.getenv("CHATBOT_BATCH_MAX_ITEMS", "100"))
+BATCH_WORKERS = int(os.getenv("CHATBOT_BATCH_WORKERS", "8"))
+batch_executor = ThreadPoolExecutor(
+    max_workers=BATCH_WORKERS, thread_name_prefix="chatbot-batch"
+)
+
+
+# Read a /chat/batch body: a list of chat requests, or {"items": [...]}
+def parse_batch_request(data):
+    items = data.get("items") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+        raise ValueError("Expected a list of chat requests")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"A batch can hold at most {BATCH_MAX_ITEMS} messages")
+    return [parse_chat_request(item) for item in items]
+
+
+# Group batch positions by conversation, keeping input order within each group
+def group_batch_items(requests):
+    groups = {}
+    for index, (_, user_type, conversation_id) in enumerate(requests):
+        key = conversation_id or f"default_{user_type}"
+        groups.setdefault(key, []).append(index)
+    return list(groups.values())
+
+
+# Function to answer a batch of chat requests. Conversations run concurrently
+# on the batch pool and messages within one conversation run in order.
+# Returns (response_data, seconds) for each request, in input order.
+def generate_batch_responses(requests, identity=None):
+    # Routing is local and cheap, so it runs for the whole batch up front
+    intents = [
+        match_intent(message, user_type) if message else None
+        for message, user_type, _ in requests
+    ]
+    results = [None] * len(requests)
+
+    def run_group(indexes):
+        for index in indexes:
+            started = time.perf_counter()
+            message, user_type, conversation_id = requests[index]
+            response_data = generate_response(
+                message, user_type, conversation_id, intents[index], identity=identity
+            )
+            results[index] = (response_data, time.perf_counter() - started)
+
+    list(batch_executor.map(run_group, group_batch_items(requests)))
+    return results
+
+
+# Shape the /chat/batch response body
+def batch_payload(requests, results, seconds):
+    return {
+        "results": [
+            {
+                **chat_payload(message, user_type, conversation_id, response_data),
+                "timingMs": round(item_seconds * 1000, 2),
+            }
+            for (message, user_type, conversation_id), (
+                response_data,
+                item_seconds,
+            ) in zip(requests, results)
+        ],
+        "totalMs": round(seconds * 1000, 2),
+    }
+
+
+# Shape the /chat response body
+def chat_payload(message, user_type, conversation_id, response_data):
+    return {
+        "message": message,
+        "userType": user_type,
+        "response": response_data["response"],
+        "link": response_data.get("link", None),
+        "loginRequired": response_data.get("loginRequired", False),
+        "actionText": response_data.get("actionText", "access this feature"),
+        "featureName": response_data.get("featureName", "this feature"),
+        "linkText": response_data.get(
+            "linkText", "Click here"
+        ),  # Include link text in response
+        "conversationId": response_data.get("conversationId", conversation_id),
+        "servedBy": response_data.get("servedBy", "local"),
+    }
+
+
+# Start a trace for the current request, reusing the caller's X-Trace-Id
+def request_trace():
+    return Trace(request.headers.get("X-Trace-Id"))
+
+
+# Function to read the caller from the request's bearer token, used for
+# admission priority and answers from student records
+def request_identity(authorization):
+    return verify_token(authorization, JWT_SECRET)
+
+
+# Function to rank a request for admission, 0 being the highest. When tokens
+# can be verified, only a valid login token earns priority; otherwise the
+# role the client sent is trusted.
+def admission_priority(user_type, identity):
+    if identity is not None:
+        role = identity.role
+    elif token_auth_enabled(JWT_SECRET):
+        role = "guest"
+    else:
+        role = (user_type or "guest").lower()
+    return _role_priorities.get(role, len(ADMISSION_PRIORITIES) - 1)
+
+
+# Function to hold an admission slot for the length of a request. Yields
+# the request's priority when it was admitted, or None when it was shed.
+@contextmanager
+def admission_slot(user_type, identity):
+    priority = admission_priority(user_type, identity)
+    if admission is None:
+        yield priority
+        return
+    started = time.perf_counter()
+    admitted = admission.acquire(priority)
+    admission_wait.observe(
+        ADMISSION_PRIORITIES[priority], time.perf_counter() - started
+    )
+    if not admitted:
+        yield None
+        return
+    try:
+        yield priority
+    finally:
+        admission.release()
+
+
+# Function to answer a request shed under overload without touching the
+# conversation or the model: guests are asked to log in, everyone else gets
+# the busy reply
+def shed_response(message, user_type, conversation_id, intent, started):
+    if not user_type or user_type.lower() == "guest":
+        response = login_reply(message)
+        intent = intent._replace(login_required=True)
+    else:
+        response = busy_answer(intent)
+    elapsed = time.perf_counter() - started
+    served_latency.record("shed", elapsed)
+    response_seconds.observe("shed", elapsed)
+    return {
+        "response": response,
+        "conversationId": conversation_id,
+        "servedBy": "shed",
+        **describe_intent(intent),
+    }
+
+
+# Add the trace ID and the stage timings to a response
+def with_trace_headers(response, trace):
+    response.headers["X-Trace-Id"] = trace.trace_id
+    if trace.timings:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    try:
+        message, user_type, conversation_id = parse_chat_request(request.get_json())
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    trace = request_trace()
+
     # Get response from AI model
-    response_data = generate_response(message, user_type, conversation_id)
-
-    return jsonify(
-        {
-            "message": message,
-            "userType": user_type,
-            "response": response_data["response"],
-            "link": response_data.get("link", None),
-            "loginRequired": response_data.get("loginRequired", False),
-            "actionText": response_data.get("actionText", "access this feature"),
-            "featureName": response_data.get("featureName", "this feature"),
-            "linkText": response_data.get(
-                "linkText", "Click here"
-            ),  # Include link text in response
-            "conversationId": response_data.get("conversationId", conversation_id),
-        }
+    identity = request_identity(request.headers.get("Authorization"))
+    response_data = generate_response(
+        message, user_type, conversation_id, trace=trace, identity=identity
+    )
+
+    return with_trace_headers(
+        jsonify(chat_payload(message, user_type, conversation_id, response_data)),
+        trace,
+    )
+
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    started = time.perf_counter()
+    try:
+        requests = parse_batch_request(request.get_json(silent=True))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+
+    results = generate_batch_responses(
+        requests, request_identity(request.headers.get("Authorization"))
+    )
+    return with_trace_headers(
+        jsonify(batch_payload(requests, results, time.perf_counter() - started)),
+        request_trace(),
+    )
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    try:
+        message, user_type, conversation_id = parse_chat_request(request.get_json())
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    trace = request_trace()
+    identity = request_identity(request.headers.get("Authorization"))
+
+    def events():
+        for event, data in generate_response_stream(
+            message, user_type, conversation_id, trace, identity
+        ):
+            if event == "done":
+                data = chat_payload(message, user_type, conversation_id, data)
+            yield sse_event(event, data)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        # Stage timings are only known once the stream ends, after the headers
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Trace-Id": trace.trace_id,
+        },
+    )
+
+
+# Function to report how long this process took to start and its memory.
+# Under a preloading server the import ran once in the master before forking.
+def startup_stats():
+    return {
+        "pid": os.getpid(),
+        "importSeconds": import_seconds,
+        "clientSeconds": client_seconds,
+        "warmSeconds": warm_seconds,
+        "warmedConnections": warmed_connections,
+        "rssBytes": rss_bytes(),
+    }
+
+
+# Collect the service counters reported at /chat/stats
+def service_stats():
+    return {
+        "conversations": conversations.stats(),
+        "conversationLocks": conversation_locks.stats(),
+        "responseCache": response_cache.stats(),
+        "semanticCache": semantic_cache.stats() if semantic_cache else None,
+        "summarizer": summarizer.stats() if summarizer else None,
+        "studentData": student_data.stats() if student_data else None,
+        "coalescing": model_flights.stats(),
+        "modelLimiter": model_bucket.stats(),
+        "circuitBreaker": model_breaker.stats(),
+        "admission": admission.stats() if admission else None,
+        "servedBy": served_latency.stats(),
+        "modelRouter": model_router.stats(),
+        "startup": startup_stats(),
+    }
+
+
+@app.route("/chat/stats", methods=["GET"])
+def chat_stats():
+    return jsonify(service_stats())
+
+
+_breaker_states = ("closed", "halfOpen", "open")
+
+
+# Render the pipeline metrics in the Prometheus text format. The ASGI server
+# passes its own coalescing counters.
+def render_metrics(flights=model_flights):
+    cache = response_cache.stats()
+    store = conversations.stats()
+    limiter = model_bucket.stats()
+    breaker = model_breaker.stats()
+    router = model_router.stats()
+    locks = conversation_locks.stats()
+    lines = [
+        *stage_seconds.render(),
+        *response_seconds.render(),
+        *tier_seconds.render(),
+        *admission_wait.render(),
+        *model_errors.render(),
+        *model_retries.render(),
+        *render_sample(
+            "chatbot_cache_lookups_total",
+            "Response cache lookups by result",
+            {
+                "hit": cache["hits"],
+                "miss": cache["misses"],
+                "bypass": cache["bypassed"],
+            },
+            label="result",
+            kind="counter",
+        ),
+        *render_sample(
+            "chatbot_cache_hit_ratio",
+            "Share of cache lookups answered from the cache, by tier",
+            {
+                "exact": cache["hitRatio"],
+                "semantic": semantic_cache.stats()["hitRatio"] if semantic_cache else 0,
+            },
+            label="tier",
+        ),
+        *render_sample(
+            "chatbot_cache_entries",
+            "Replies held in the response cache",
+            cache["entries"],
+        ),
+        *render_sample(
+            "chatbot_coalesced_requests_total",
+            "Requests that shared an identical in-flight model call",
+            flights.stats()["coalesced"],
+            kind="counter",
+        ),
+        *render_sample(
+            "chatbot_conversation_queued_turns",
+            "Turns waiting for an earlier turn of their conversation",
+            locks["queuedTurns"],
+        ),
+        *render_sample(
+            "chatbot_conversation_waits_total",
+            "Turns that waited for an earlier turn of their conversation",
+            locks["waited"],
+            kind="counter",
+        ),
+        *render_sample(
+            "chatbot_model_rate_limit_per_second",
+            "Current client-side model rate limit",
+            limiter["ratePerSecond"],
+        ),
+        *render_sample(
+            "chatbot_model_rate_limited_total",
+            "Model calls refused because no rate limit token arrived in time",
+            limiter["rejected"],
+            kind="counter",
+        ),
+        *render_sample(
+            "chatbot_model_hedges_total",
+            "Slow model calls also sent to a faster tier",
+            router["hedged"],
+            kind="counter",
+        ),
+        *render_sample(
+            "chatbot_model_hedge_wins_total",
+            "Hedged model calls answered first by the faster tier",
+            router["hedgeWins"],
+            kind="counter",
+        ),
+        *render_sample(
+            "chatbot_circuit_breaker_state",
+            "1 for the circuit breaker's current state",
+            {state: state == breaker["state"] for state in _breaker_states},
+            label="state",
+        ),
+        *render_sample(
+            "chatbot_circuit_breaker_rejected_total",
+            "Model calls refused while the circuit breaker was open",
+            breaker["rejected"],
+            kind="counter",
+        ),
+    ]
+    if admission:
+        queued = admission.stats()
+        lines += render_sample(
+            "chatbot_admission_queue_depth",
+            "Requests waiting for admission, by priority",
+            dict(zip(ADMISSION_PRIORITIES, queued["queueDepth"])),
+            label="priority",
+        )
+        lines += render_sample(
+            "chatbot_admission_admitted_total",
+            "Requests admitted, by priority",
+            dict(zip(ADMISSION_PRIORITIES, queued["admitted"])),
+            label="priority",
+            kind="counter",
+        )
+        lines += render_sample(
+            "chatbot_admission_shed_total",
+            "Requests shed under overload, by priority",
+            dict(zip(ADMISSION_PRIORITIES, queued["shed"])),
+            label="priority",
+            kind="counter",
+        )
+    # Redis reports memory for the whole server rather than per conversation
+    if "conversations" in store:
+        lines += render_sample(
+            "chatbot_active_conversations",
+            "Conversations held in the conversation store",
+            store["conversations"],
+        )
+    lines += render_sample(
+        "chatbot_conversation_store_bytes",
+        "Memory used by conversation history",
+        store.get("contentBytes", store.get("usedMemoryBytes", 0)),
     )
+    lines += render_sample(
+        "chatbot_import_seconds",
+        "Time taken to import the service and build its tables",
+        import_seconds,
+    )
+    lines += render_sample(
+        "process_resident_memory_bytes", "Resident memory of this process", rss_bytes()
+    )
+    return "\n".join(lines) + "\n"
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 
+# Return the app for a production server, e.g. gunicorn "chatbot:create_app()"
+# with gunicorn.conf.py. The routing tables and FAQ answers are built when this
+# module is imported, so a preloading server builds them once for all workers.
+def create_app():
+    # Log through gunicorn's handlers when running under it
+    gunicorn_logger = logging.getLogger("gunicorn.error")
+    if gunicorn_logger.handlers:
+        app.logger.handlers = gunicorn_logger.handlers
+        app.logger.setLevel(gunicorn_logger.level)
+    return app
+
+
+import_seconds = time.perf_counter() - import_started
+
 if __name__ == "__main__":
-    app.run(host="https://emis-avxn.onrender.com", port=5000)
+    # Flask's development server; use gunicorn.conf.py in production
+    warm_model_client()
+    app.run(
+        host=os.getenv("CHATBOT_HOST", "0.0.0.0"), port=int(os.getenv("PORT", "5000"))
+    )
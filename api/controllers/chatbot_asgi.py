@@ -0,0 +1,555 @@
+# ASGI variant of the chatbot service. Model calls use the async genai client,
+# so one process can hold many requests in flight while waiting on Gemini.
+#
+#   uvicorn chatbot_asgi:app --app-dir api/controllers --port 5000
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager, nullcontext
+
+from google.api_core import retry
+
+import chatbot
+from metrics import Trace, render_sample
+from model_guard import ModelUnavailable
+from model_transport import warm_connections_async
+from single_flight import SingleFlight
+
+# Same retry policy as the blocking client in chatbot.py
+model_retry = retry.AsyncRetry(
+    predicate=chatbot.is_retriable,
+    initial=0.5,
+    maximum=4,
+    timeout=chatbot.MODEL_DEADLINE,
+    on_error=chatbot.record_model_retry,
+)
+
+
+class ConcurrencyLimiter:
+    """Caps concurrent model calls and counts the requests queued behind the cap"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.completed = 0
+
+    async def __aenter__(self):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight -= 1
+        self.completed += 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "inFlight": self.in_flight,
+            "queueDepth": self.waiting,
+            "maxQueueDepth": self.max_waiting,
+            "completed": self.completed,
+        }
+
+
+model_limiter = ConcurrencyLimiter(int(os.getenv("CHATBOT_MAX_CONCURRENCY", "256")))
+
+# Identical questions asked at the same time share one model call. Futures
+# belong to the server's event loop, so they are created on first use.
+model_flights = SingleFlight(lambda: asyncio.get_running_loop().create_future())
+
+
+# Async counterpart of chatbot.acquire_model_token
+async def acquire_model_token(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0 or not await chatbot.model_bucket.acquire_async(remaining):
+        raise ModelUnavailable("rate limit not met before the deadline")
+    return chatbot.model_request_config(deadline)
+
+
+# Async counterpart of chatbot.generate_model_content. The breaker and the
+# rate limiter are shared with the blocking client.
+async def generate_model_content(prompt, model=chatbot.GEMINI_MODEL):
+    chatbot.check_model_breaker()
+    deadline = time.monotonic() + chatbot.MODEL_DEADLINE
+
+    async def attempt():
+        config = await acquire_model_token(deadline)
+        async with model_limiter:
+            return await chatbot.get_client().aio.models.generate_content(
+                model=model, contents=prompt, config=config
+            )
+
+    try:
+        response = await model_retry(attempt)()
+    except Exception as error:
+        chatbot.record_model_error(error)
+        raise
+    chatbot.record_model_success()
+    return response
+
+
+# Async counterpart of chatbot.stream_model_content
+async def stream_model_content(prompt, model=chatbot.GEMINI_MODEL):
+    chatbot.check_model_breaker()
+    config = await acquire_model_token(time.monotonic() + chatbot.MODEL_DEADLINE)
+    try:
+        async with model_limiter:
+            stream = await chatbot.get_client().aio.models.generate_content_stream(
+                model=model, contents=prompt, config=config
+            )
+            async for chunk in stream:
+                yield chunk
+    except Exception as error:
+        chatbot.record_model_error(error)
+        raise
+    chatbot.record_model_success()
+
+
+# Async counterpart of chatbot.join_model_call
+async def join_model_call(turn):
+    flight, leader = model_flights.join(turn.cache_key)
+    if not leader:
+        # Shielded so a follower that disconnects does not cancel the leader
+        started = time.perf_counter()
+        turn.response = await asyncio.shield(flight)
+        turn.source = "coalesced"
+        chatbot.record_stage(turn.trace, "coalesce", started)
+    return leader
+
+
+# Async counterpart of chatbot.call_routed_model. The slower call is cancelled
+# once one of them answers.
+async def call_routed_model(turn):
+    router = chatbot.model_router
+    hedge = router.hedge_tier(turn.tier)
+    if hedge is None:
+        return await generate_model_content(turn.prompt, router.model(turn.tier))
+
+    primary = asyncio.create_task(
+        generate_model_content(turn.prompt, router.model(turn.tier))
+    )
+    calls = {primary: turn.tier}
+    pending = {primary}
+    error = None
+    try:
+        done, pending = await asyncio.wait(pending, timeout=router.hedge_after)
+        if not done:
+            hedged = asyncio.create_task(
+                generate_model_content(turn.prompt, router.model(hedge))
+            )
+            calls[hedged] = hedge
+            pending.add(hedged)
+            router.record_hedge()
+        while True:
+            for call in done:
+                if call.exception() is None:
+                    if call is not primary:
+                        router.record_hedge_win()
+                    turn.tier = calls[call]
+                    return call.result()
+                error = error or call.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+    finally:
+        # Also cancels both calls when the client goes away
+        for call in pending:
+            call.cancel()
+
+
+# Async counterpart of chatbot.hold_conversation
+def hold_conversation(conversation_id):
+    if not conversation_id:
+        return nullcontext()
+    return chatbot.conversation_locks.hold_async(conversation_id)
+
+
+# Async counterpart of chatbot.admission_slot
+@asynccontextmanager
+async def admission_slot(user_type, identity):
+    priority = chatbot.admission_priority(user_type, identity)
+    admission = chatbot.admission
+    if admission is None:
+        yield priority
+        return
+    started = time.perf_counter()
+    admitted = await admission.acquire_async(priority)
+    chatbot.admission_wait.observe(
+        chatbot.ADMISSION_PRIORITIES[priority], time.perf_counter() - started
+    )
+    if not admitted:
+        yield None
+        return
+    try:
+        yield priority
+    finally:
+        admission.release()
+
+
+# Async counterpart of chatbot.run_turn
+async def run_turn(
+    message,
+    user_type=None,
+    conversation_id=None,
+    intent=None,
+    trace=None,
+    identity=None,
+):
+    async with hold_conversation(conversation_id):
+        # History reads and writes may hit SQLite or Redis, keep them off the loop
+        turn = await asyncio.to_thread(
+            chatbot.prepare_turn,
+            message,
+            user_type,
+            conversation_id,
+            intent,
+            trace,
+            identity,
+        )
+        if turn.response is None and await join_model_call(turn):
+            try:
+                started = time.perf_counter()
+                response = await call_routed_model(turn)
+                started = chatbot.record_stage(turn.trace, "model", started)
+                turn.response = chatbot.clean_response(response.text)
+                chatbot.record_stage(turn.trace, "clean", started)
+            except ModelUnavailable:
+                turn.response = chatbot.fallback_answer(turn)
+            except Exception as error:
+                chatbot.log_model_error(turn, error)
+            finally:
+                model_flights.finish(turn.cache_key, turn.response)
+        await asyncio.to_thread(chatbot.finish_turn, turn)
+    return turn
+
+
+# Async counterpart of chatbot.generate_response
+async def generate_response(
+    message,
+    user_type=None,
+    conversation_id=None,
+    intent=None,
+    trace=None,
+    identity=None,
+):
+    if not message:
+        return {"response": "Please provide a message.", "link": "/help"}
+
+    received = time.perf_counter()
+    if trace is None:
+        trace = Trace()
+    if intent is None:
+        intent = chatbot.match_intent(message, user_type)
+        chatbot.record_stage(trace, "route", received)
+
+    async with admission_slot(user_type, identity) as priority:
+        if priority is None:
+            return chatbot.shed_response(
+                message, user_type, conversation_id, intent, received
+            )
+        turn = await run_turn(
+            message, user_type, conversation_id, intent, trace, identity
+        )
+
+    return {
+        "response": turn.response,
+        "conversationId": conversation_id,
+        "servedBy": turn.source,
+        **chatbot.describe_intent(intent),
+    }
+
+
+# Async counterpart of chatbot.generate_response_stream
+async def generate_response_stream(
+    message, user_type=None, conversation_id=None, trace=None, identity=None
+):
+    if not message:
+        response_text = "Please provide a message."
+        yield "token", {"text": response_text}
+        yield "done", {"response": response_text, "link": "/help"}
+        return
+
+    received = time.perf_counter()
+    if trace is None:
+        trace = Trace()
+    intent = chatbot.match_intent(message, user_type)
+    chatbot.record_stage(trace, "route", received)
+    response_data = {
+        "conversationId": conversation_id,
+        **chatbot.describe_intent(intent),
+    }
+    yield "meta", response_data
+
+    async with admission_slot(user_type, identity) as priority:
+        if priority is None:
+            response_data = chatbot.shed_response(
+                message, user_type, conversation_id, intent, received
+            )
+            yield "token", {"text": response_data["response"]}
+            yield "done", response_data
+            return
+
+        async with hold_conversation(conversation_id):
+            turn = await asyncio.to_thread(
+                chatbot.prepare_turn,
+                message,
+                user_type,
+                conversation_id,
+                intent,
+                trace,
+                identity,
+            )
+            leader = turn.response is None and await join_model_call(turn)
+            if turn.response is not None:
+                yield "token", {"text": turn.response}
+            elif leader:
+                cleaner = chatbot.ResponseCleaner()
+                parts = []
+                started = time.perf_counter()
+                try:
+                    async for chunk in stream_model_content(
+                        turn.prompt, chatbot.model_router.model(turn.tier)
+                    ):
+                        text = cleaner.feed(chunk.text or "")
+                        if text:
+                            parts.append(text)
+                            yield "token", {"text": text}
+                    text = cleaner.flush()
+                    if text:
+                        parts.append(text)
+                        yield "token", {"text": text}
+                    turn.response = "".join(parts)
+                except ModelUnavailable:
+                    turn.response = chatbot.fallback_answer(turn)
+                    yield "token", {"text": turn.response}
+                except Exception as error:
+                    chatbot.log_model_error(turn, error)
+                finally:
+                    model_flights.finish(turn.cache_key, turn.response)
+                    chatbot.record_stage(turn.trace, "model", started)
+
+            response_text = await asyncio.to_thread(chatbot.finish_turn, turn)
+    yield "done", {**response_data, "response": response_text, "servedBy": turn.source}
+
+
+async def chat(body, trace, identity):
+    try:
+        message, user_type, conversation_id = chatbot.parse_chat_request(body)
+    except ValueError as error:
+        return 400, {"error": str(error)}
+    response_data = await generate_response(
+        message, user_type, conversation_id, trace=trace, identity=identity
+    )
+    return 200, chatbot.chat_payload(message, user_type, conversation_id, response_data)
+
+
+async def chat_batch(body, trace, identity):
+    started = time.perf_counter()
+    try:
+        requests = chatbot.parse_batch_request(body)
+    except ValueError as error:
+        return 400, {"error": str(error)}
+
+    # Routing for the whole batch happens up front, as in chatbot.py
+    intents = [
+        chatbot.match_intent(message, user_type) if message else None
+        for message, user_type, _ in requests
+    ]
+    results = [None] * len(requests)
+    pool = asyncio.Semaphore(chatbot.BATCH_WORKERS)
+
+    async def run_group(indexes):
+        async with pool:
+            for index in indexes:
+                item_started = time.perf_counter()
+                message, user_type, conversation_id = requests[index]
+                response_data = await generate_response(
+                    message,
+                    user_type,
+                    conversation_id,
+                    intents[index],
+                    identity=identity,
+                )
+                results[index] = (response_data, time.perf_counter() - item_started)
+
+    await asyncio.gather(
+        *[run_group(indexes) for indexes in chatbot.group_batch_items(requests)]
+    )
+    return 200, chatbot.batch_payload(requests, results, time.perf_counter() - started)
+
+
+async def chat_stream(body, trace, identity):
+    try:
+        message, user_type, conversation_id = chatbot.parse_chat_request(body)
+    except ValueError as error:
+        return 400, {"error": str(error)}
+
+    async def events():
+        async for event, data in generate_response_stream(
+            message, user_type, conversation_id, trace, identity
+        ):
+            if event == "done":
+                data = chatbot.chat_payload(message, user_type, conversation_id, data)
+            yield chatbot.sse_event(event, data).encode("utf-8")
+
+    return 200, events()
+
+
+async def chat_stats(body, trace, identity):
+    stats = await asyncio.to_thread(chatbot.service_stats)
+    return 200, {
+        **stats,
+        "coalescing": model_flights.stats(),
+        "modelCalls": model_limiter.stats(),
+    }
+
+
+async def metrics(body, trace, identity):
+    text = await asyncio.to_thread(chatbot.render_metrics, model_flights)
+    limiter = model_limiter.stats()
+    lines = [
+        *render_sample(
+            "chatbot_model_calls_in_flight",
+            "Model calls currently running",
+            limiter["inFlight"],
+        ),
+        *render_sample(
+            "chatbot_model_queue_depth",
+            "Requests waiting for a model call slot",
+            limiter["queueDepth"],
+        ),
+    ]
+    return 200, text + "\n".join(lines) + "\n"
+
+
+routes = {
+    ("POST", "/chat"): chat,
+    ("POST", "/chat/batch"): chat_batch,
+    ("POST", "/chat/stream"): chat_stream,
+    ("GET", "/chat/stats"): chat_stats,
+    ("GET", "/metrics"): metrics,
+}
+
+
+def _cors_headers(scope):
+    headers = dict(scope["headers"])
+    origin = headers.get(b"origin", b"").decode("latin-1")
+    if origin not in chatbot.CORS_ORIGINS:
+        return []
+    cors = [
+        (b"access-control-allow-origin", origin.encode("latin-1")),
+        (b"vary", b"Origin"),
+        (b"access-control-expose-headers", b"X-Trace-Id, Server-Timing"),
+    ]
+    if scope["method"] == "OPTIONS":
+        cors.append((b"access-control-allow-methods", b"GET, POST, OPTIONS"))
+        requested = headers.get(b"access-control-request-headers")
+        if requested:
+            cors.append((b"access-control-allow-headers", requested))
+    return cors
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        event = await receive()
+        chunks.append(event.get("body", b""))
+        if not event.get("more_body"):
+            return b"".join(chunks)
+
+
+# Function to open the async client's model connections, like
+# chatbot.warm_model_client does for the blocking client
+async def warm_model_client():
+    started = time.perf_counter()
+    warmed = await warm_connections_async(
+        chatbot.get_client(), chatbot.GEMINI_MODEL, chatbot.WARM_CONNECTIONS
+    )
+    chatbot.warm_seconds = time.perf_counter() - started
+    chatbot.warmed_connections = warmed
+    if warmed < chatbot.WARM_CONNECTIONS:
+        chatbot.app.logger.warning(
+            "Opened %d of %d model connections", warmed, chatbot.WARM_CONNECTIONS
+        )
+    return warmed
+
+
+async def _lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            # The server takes no requests until startup completes
+            await warm_model_client()
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    headers = _cors_headers(scope)
+    request_headers = dict(scope["headers"])
+    trace = Trace(request_headers.get(b"x-trace-id", b"").decode("latin-1"))
+    identity = chatbot.request_identity(
+        request_headers.get(b"authorization", b"").decode("latin-1")
+    )
+    handler = routes.get((scope["method"], scope["path"]))
+    if scope["method"] == "OPTIONS":
+        status, payload = 200, None
+    elif handler is None:
+        status, payload = 404, {"error": "Not found"}
+    else:
+        raw = await _read_body(receive)
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            status, payload = 400, {"error": "Invalid JSON body"}
+        else:
+            status, payload = await handler(body, trace, identity)
+
+    headers.append((b"x-trace-id", trace.trace_id.encode("latin-1")))
+    if hasattr(payload, "__aiter__"):
+        headers += [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ]
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        async for chunk in payload:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    if trace.timings:
+        headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+    if isinstance(payload, str):
+        content = payload.encode("utf-8")
+        headers.append((b"content-type", b"text/plain; version=0.0.4"))
+    else:
+        content = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        if payload is not None:
+            headers.append((b"content-type", b"application/json"))
+    headers.append((b"content-length", str(len(content)).encode("latin-1")))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": content})
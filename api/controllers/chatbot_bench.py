@@ -0,0 +1,759 @@
+# Benchmarks for the chatbot service with the Gemini model replaced by a local
+# fake, so runs are reproducible and free. Reports latency percentiles,
+# throughput and memory growth for /chat, cold start and per-worker memory,
+# model client latency per connection pool size, plus microbenchmarks of the
+# routing and response cleaning hot path.
+#
+#   python controllers/chatbot_bench.py                      # everything
+#   python controllers/chatbot_bench.py startup --workers 8
+#   python controllers/chatbot_bench.py store --conversations 20000
+#   python controllers/chatbot_bench.py ordering --threads 1 4 16 64
+#   python controllers/chatbot_bench.py transport --pool-sizes 1 4 16
+#   python controllers/chatbot_bench.py server --concurrency 32 --latency 0.2
+#   python controllers/chatbot_bench.py micro
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+import urllib.request
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Benchmarks measure the service, not the quota or a previous FAQ build
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+os.environ.setdefault("CHATBOT_MODEL_RPM", "1000000")
+os.environ.setdefault("CHATBOT_MODEL_BURST", "1000000")
+os.environ["CHATBOT_FAQ_FILE"] = ""
+
+from google import genai
+from werkzeug.serving import make_server
+
+import chatbot
+import conversation_store
+from metrics import rss_bytes
+from model_transport import create_model_client, warm_connections
+
+# Messages covering each serving path: greetings, login prompts, navigation
+# answered locally, and open questions that reach the model
+SAMPLE_MESSAGES = [
+    ("hello", "guest"),
+    ("how do I log in as a teacher", "guest"),
+    ("where can I see attendance", "teacher"),
+    ("open the marks page", "teacher"),
+    ("how is my child doing in school this term", "parent"),
+    ("what can I do with the fees section", "parent"),
+    ("explain how school budgets are allocated", "principal"),
+    ("can you summarise what district heads are responsible for", "districthead"),
+    ("what should I check before adding a new teacher", "admin"),
+]
+
+# Model replies include the markdown the cleaner has to strip
+FAKE_REPLY = (
+    "**Answer:** You can see this on your dashboard. 1. **Reasoning**: the "
+    "feature is part of your role.\n\nUse the link below to open it."
+)
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModels:
+    """Stands in for client.models with a fixed latency and injected 503 errors"""
+
+    def __init__(self, latency=0.05, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def _fail(self):
+        with self._lock:
+            self.calls += 1
+            if self._random.random() >= self.error_rate:
+                return False
+            self.errors += 1
+            return True
+
+    def generate_content(self, model=None, contents=None, config=None):
+        time.sleep(self.latency)
+        if self._fail():
+            raise genai.errors.ServerError(
+                503, {"error": {"message": "Injected error", "status": "UNAVAILABLE"}}
+            )
+        return FakeResponse(FAKE_REPLY)
+
+    def generate_content_stream(self, model=None, contents=None, config=None):
+        response = self.generate_content(model, contents, config)
+        for start in range(0, len(response.text), 16):
+            yield FakeResponse(response.text[start : start + 16])
+
+
+class RssSampler:
+    """Samples RSS on a background thread while a benchmark runs"""
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.samples.append(rss_bytes())
+
+    def stats(self):
+        return {
+            "startMb": round(self.samples[0] / 2**20, 2),
+            "peakMb": round(max(self.samples) / 2**20, 2),
+            "endMb": round(self.samples[-1] / 2**20, 2),
+            "growthMb": round((self.samples[-1] - self.samples[0]) / 2**20, 2),
+        }
+
+
+# Function to get the value below which `percent` of the sorted values fall
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+# Function to build the request bodies for a run. With unique set, every
+# message is new so nothing is served from the response cache.
+def chat_requests(count, unique, seed):
+    rng = random.Random(seed)
+    requests = []
+    for index in range(count):
+        message, user_type = rng.choice(SAMPLE_MESSAGES)
+        if unique:
+            message = f"{message} {index}"
+        requests.append(
+            {
+                "message": message,
+                "userType": user_type,
+                "conversationId": f"bench_{index % 200}",
+            }
+        )
+    return requests
+
+
+# Function to send requests with `concurrency` threads and summarise the latencies
+def run_load(send, requests, concurrency):
+    def timed(body):
+        started = time.perf_counter()
+        ok = send(body)
+        return time.perf_counter() - started, ok
+
+    with RssSampler() as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(timed, requests))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(seconds for seconds, _ in results)
+    return {
+        "requests": len(results),
+        "failed": sum(1 for _, ok in results if not ok),
+        "concurrency": concurrency,
+        "requestsPerSecond": round(len(results) / elapsed, 2),
+        "p50Ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95Ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99Ms": round(percentile(latencies, 99) * 1000, 2),
+        "maxMs": round(latencies[-1] * 1000 if latencies else 0.0, 2),
+        "rss": sampler.stats(),
+    }
+
+
+# Function to drive /chat through the Flask test client, inside this process
+def bench_test_client(requests, concurrency):
+    local = threading.local()
+
+    def send(body):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = chatbot.app.test_client()
+        return client.post("/chat", json=body).status_code == 200
+
+    return run_load(send, requests, concurrency)
+
+
+# Function to drive /chat through a real threaded HTTP server on a local port
+def bench_server(requests, concurrency):
+    # Access logs would dominate the output and the timings
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, chatbot.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_port}/chat"
+
+    def send(body):
+        request = urllib.request.Request(
+            url,
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                response.read()
+                return response.status == 200
+        except OSError:
+            return False
+
+    try:
+        return run_load(send, requests, concurrency)
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+# Function to read the memory only this process uses, i.e. not shared with
+# the process it was forked from. None where /proc is not available.
+def private_bytes():
+    try:
+        with open("/proc/self/smaps_rollup") as smaps:
+            return sum(
+                int(line.split()[1]) * 1024
+                for line in smaps
+                if line.startswith(("Private_Clean:", "Private_Dirty:"))
+            )
+    except OSError:
+        return None
+
+
+# Function to serve a first request in a forked worker and report its memory
+def worker_probe():
+    started = time.perf_counter()
+    models = chatbot.get_client().models
+    fake = FakeModels(latency=0)
+    models.generate_content = fake.generate_content
+    models.generate_content_stream = fake.generate_content_stream
+    client = chatbot.app.test_client()
+    for message, user_type in SAMPLE_MESSAGES:
+        client.post("/chat", json={"message": message, "userType": user_type})
+    private = private_bytes()
+    return {
+        "firstRequestsMs": round((time.perf_counter() - started) * 1000, 2),
+        "clientMs": round(chatbot.client_seconds * 1000, 2),
+        "rssMb": round(rss_bytes() / 2**20, 2),
+        "privateMb": round(private / 2**20, 2) if private is not None else None,
+    }
+
+
+# Function to measure cold start, and the memory of workers forked after the
+# service was imported the way gunicorn's preload_app runs them
+def bench_startup(workers):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import chatbot"], cwd=directory, check=True)
+    results = {
+        "processStartSeconds": round(time.perf_counter() - started, 3),
+        "importSeconds": round(chatbot.import_seconds, 3),
+        "preloadedRssMb": round(rss_bytes() / 2**20, 2),
+        "workers": [],
+    }
+    if not hasattr(os, "fork"):
+        return results
+    children = []
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                os.write(write_fd, json.dumps(worker_probe()).encode("utf-8"))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        children.append((pid, read_fd))
+    for pid, read_fd in children:
+        with os.fdopen(read_fd) as pipe:
+            output = pipe.read()
+        os.waitpid(pid, 0)
+        results["workers"].append(json.loads(output) if output else None)
+    return results
+
+
+# Function to build the turns of one conversation: short questions and
+# longer answers, drawn from the sample messages and the fake reply
+def conversation_turns(rng, turns):
+    entries = []
+    for index in range(turns):
+        if index % 2:
+            words = FAKE_REPLY.split()
+            rng.shuffle(words)
+            entries.append({"role": "assistant", "content": " ".join(words)})
+        else:
+            message = f"{rng.choice(SAMPLE_MESSAGES)[0]} {rng.randrange(10**6)}"
+            entries.append({"role": "user", "content": message})
+    return entries
+
+
+# Function to measure the bytes held per stored turn by the old layout (a
+# dict per entry in a deque per conversation), the compact memory store, and
+# the store once idle conversations are compressed
+def bench_store(conversations, turns=10, seed=0):
+    def measure(fill):
+        rng = random.Random(seed)
+        tracemalloc.start()
+        try:
+            held = fill(rng)
+            used = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del held
+        return round(used / (conversations * turns), 1)
+
+    def fill_dicts(rng):
+        store = OrderedDict()
+        for index in range(conversations):
+            store[f"bench_{index}"] = [0.0, deque(conversation_turns(rng, turns)), ""]
+        return store
+
+    def fill_store(compress):
+        def fill(rng):
+            now = [0.0]
+            store = conversation_store.MemoryConversationStore(
+                max_messages=turns,
+                max_conversations=conversations,
+                compress_after=60 if compress else 0,
+                clock=lambda: now[0],
+            )
+            for index in range(conversations):
+                store.append(f"bench_{index}", *conversation_turns(rng, turns))
+            now[0] = 120
+            store.stats()
+            return store
+
+        return fill
+
+    rng = random.Random(seed)
+    content = sum(
+        sys.getsizeof(entry["content"])
+        for _ in range(conversations)
+        for entry in conversation_turns(rng, turns)
+    )
+    return {
+        "conversations": conversations,
+        "turnsPerConversation": turns,
+        "contentBytesPerTurn": round(content / (conversations * turns), 1),
+        "dictEntriesBytesPerTurn": measure(fill_dicts),
+        "compactBytesPerTurn": measure(fill_store(False)),
+        "compressedBytesPerTurn": measure(fill_store(True)),
+    }
+
+
+# Function to build a message of roughly `words` words that mentions a feature
+def sized_message(words, seed=0):
+    rng = random.Random(seed)
+    filler = "please tell me more about the school and the term this week".split()
+    tokens = [rng.choice(filler) for _ in range(words)]
+    tokens[words // 2] = "attendance"
+    return " ".join(tokens)
+
+
+# Function to time a callable per call, in microseconds (best of several runs)
+def time_call(function, *args, number=2000):
+    runs = timeit.repeat(lambda: function(*args), number=number, repeat=5)
+    return round(min(runs) / number * 1e6, 2)
+
+
+# The chain of re.sub calls clean_response used before its patterns were
+# precompiled, kept as the baseline for the cleaning benchmark
+def legacy_clean_response(response_text):
+    response_text = response_text.replace("```", "")
+    response_text = re.sub(r"\d+\.\s+\*\*.*?\*\*:", "", response_text)
+    response_text = re.sub(r"\*\*.*?\*\*", "", response_text)
+    response_text = re.sub(
+        r"Here's my reasoning and response:.*?(?=\w)",
+        "",
+        response_text,
+        flags=re.DOTALL,
+    )
+    response_text = re.sub(
+        r"As a helpful AI assistant.*?(?=\w)", "", response_text, flags=re.DOTALL
+    )
+    response_text = re.sub(r"\n\s*\n", "\n", response_text)
+    return response_text.strip()
+
+
+# Function to clean a reply the way /chat/stream does, in 16 character chunks
+def stream_clean_response(response_text):
+    cleaner = chatbot.ResponseCleaner()
+    parts = [
+        cleaner.feed(response_text[start : start + 16])
+        for start in range(0, len(response_text), 16)
+    ]
+    parts.append(cleaner.flush())
+    return "".join(parts)
+
+
+# Model output that made the old patterns backtrack: a long run of digits and
+# numbered headings that never get their colon. The rest kept the streamed
+# cleaner holding text it had to search again on every chunk: numbers that
+# could each start a heading, a reasoning phrase that never finishes, and a
+# finished one followed by more whitespace than it holds.
+ADVERSARIAL_REPLIES = {
+    "digitRun": "1" * 4000,
+    "unfinishedHeadings": "1. **Step** " * 400,
+    "headingNumbers": "1. " * 8000,
+    "unfinishedReasoning": "Here's my " * 8000,
+    "reasoningThenSpace": "Here's my reasoning and response: " + " " * 8000 + "x",
+}
+
+
+# Function to compare response cleaning with the old implementation on long
+# and adversarial replies
+def bench_cleaning():
+    results = {}
+    replies = {
+        f"{words}Words": " ".join([FAKE_REPLY] * max(1, words // 16))
+        for words in (64, 512, 4096)
+    }
+    replies.update(ADVERSARIAL_REPLIES)
+    for name, reply in replies.items():
+        number = max(3, 200000 // len(reply))
+        legacy = time_call(legacy_clean_response, reply, number=number)
+        current = time_call(chatbot.clean_response, reply, number=number)
+        results[name] = {
+            "chars": len(reply),
+            "legacyUs": legacy,
+            "cleanResponseUs": current,
+            "streamUs": time_call(stream_clean_response, reply, number=number),
+            "speedup": round(legacy / current, 2) if current else None,
+        }
+    return results
+
+
+# Fake model for the ordering benchmark: replies with the message it answered
+# and how many earlier turns of the conversation its prompt contained
+def echo_turn(latency):
+    def generate_content(model=None, contents=None, config=None):
+        time.sleep(latency)
+        turns = [line[6:] for line in contents.split("\n") if line.startswith("User: ")]
+        return FakeResponse(f"re: {turns[-1]} | saw {len(turns) - 1}")
+
+    return generate_content
+
+
+# Function to count the conversations whose stored turns are missing, split
+# up, or were answered without seeing every turn before them
+def ordering_violations(store, conversation_ids, turns):
+    violations = 0
+    for conversation_id in conversation_ids:
+        history = store.history(conversation_id)
+        expected = []
+        for index, (question, reply) in enumerate(zip(history[::2], history[1::2])):
+            expected += [
+                {"role": "user", "content": question["content"]},
+                {
+                    "role": "assistant",
+                    "content": f"re: {question['content']} | saw {index}",
+                },
+            ]
+        if len(history) != 2 * turns or history != expected:
+            violations += 1
+    return violations
+
+
+# Function to send the turns of many conversations from a growing number of
+# threads, and check that every conversation kept its turns in order. Turns
+# of one conversation are sent back to back so they race for it. The last
+# run repeats the largest thread count without the conversation locks.
+def bench_ordering(thread_counts, conversations=64, turns=8, latency=0.02):
+    conversation_ids = [f"order_{index}" for index in range(conversations)]
+    jobs = [
+        (f"turn {turn} of conversation {index}", conversation_id)
+        for index, conversation_id in enumerate(conversation_ids)
+        for turn in range(turns)
+    ]
+    models = chatbot.get_client().models
+    saved = (
+        models.generate_content,
+        chatbot.conversations,
+        chatbot.hold_conversation,
+        chatbot.model_router.hedge_after,
+    )
+    models.generate_content = echo_turn(latency)
+    chatbot.model_router.hedge_after = 0
+
+    def run(threads):
+        store = chatbot.conversations = conversation_store.MemoryConversationStore(
+            max_messages=2 * turns, max_conversations=conversations
+        )
+        chatbot.response_cache.clear()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(
+                executor.map(
+                    lambda job: chatbot.run_turn(job[0], "teacher", job[1]), jobs
+                )
+            )
+        elapsed = time.perf_counter() - started
+        return {
+            "threads": threads,
+            "turnsPerSecond": round(len(jobs) / elapsed, 2),
+            "violations": ordering_violations(store, conversation_ids, turns),
+        }
+
+    try:
+        results = {"locked": [run(threads) for threads in thread_counts]}
+        chatbot.hold_conversation = lambda conversation_id: nullcontext()
+        results["unlocked"] = run(max(thread_counts))
+    finally:
+        (
+            models.generate_content,
+            chatbot.conversations,
+            chatbot.hold_conversation,
+            chatbot.model_router.hedge_after,
+        ) = saved
+    return {
+        "conversations": conversations,
+        "turnsPerConversation": turns,
+        "modelLatencySeconds": latency,
+        **results,
+    }
+
+
+class FakeModelHandler(BaseHTTPRequestHandler):
+    """Serves the two Gemini REST calls the service makes: generateContent
+    and, for warming connections, the model's metadata"""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, delayed ACKs
+    # add tens of milliseconds to every reply on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # A local connect is nearly free, so charge each new connection what
+        # TCP and TLS setup to the model endpoint would cost
+        time.sleep(self.server.connect_latency)
+        with self.server.lock:
+            self.server.connections += 1
+        super().setup()
+
+    def _reply(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        name = self.path.split("?")[0].rsplit("/", 1)[-1]
+        self._reply({"name": f"models/{name}"})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+        self._reply(
+            {
+                "candidates": [
+                    {"content": {"parts": [{"text": FAKE_REPLY}], "role": "model"}}
+                ]
+            }
+        )
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to start a fake Gemini endpoint on a local port
+def fake_model_server(latency, connect_latency):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeModelHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.connect_latency = connect_latency
+    server.connections = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Function to measure model client latency against the fake endpoint for each
+# pool size, with and without warming the pool first: the first burst of
+# concurrent calls, then steady traffic at the same concurrency
+def bench_transport(
+    pool_sizes, requests=400, concurrency=16, latency=0.02, connect_latency=0.05
+):
+    server = fake_model_server(latency, connect_latency)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    def timed_calls(client, count):
+        def call(_):
+            started = time.perf_counter()
+            client.models.generate_content(model=chatbot.GEMINI_MODEL, contents="hi")
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = sorted(executor.map(call, range(count)))
+        return latencies, time.perf_counter() - started
+
+    def run(pool_size, warm):
+        client = create_model_client(
+            "bench",
+            max_connections=pool_size,
+            max_keepalive=pool_size,
+            base_url=base_url,
+        )
+        opened = server.connections
+        warm_ms = None
+        if warm:
+            started = time.perf_counter()
+            warm_connections(client, chatbot.GEMINI_MODEL, pool_size)
+            warm_ms = round((time.perf_counter() - started) * 1000, 2)
+        first, _ = timed_calls(client, concurrency)
+        steady, elapsed = timed_calls(client, requests)
+        client.close()
+        return {
+            "poolSize": pool_size,
+            "warmed": warm,
+            "warmMs": warm_ms,
+            "firstBurstP50Ms": round(percentile(first, 50) * 1000, 2),
+            "firstBurstMaxMs": round(first[-1] * 1000, 2),
+            "steadyP50Ms": round(percentile(steady, 50) * 1000, 2),
+            "steadyP95Ms": round(percentile(steady, 95) * 1000, 2),
+            "requestsPerSecond": round(requests / elapsed, 2),
+            "connectionsOpened": server.connections - opened,
+        }
+
+    try:
+        runs = [
+            run(pool_size, warm) for pool_size in pool_sizes for warm in (False, True)
+        ]
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        "concurrency": concurrency,
+        "modelLatencySeconds": latency,
+        "connectLatencySeconds": connect_latency,
+        "runs": runs,
+    }
+
+
+# Function to microbenchmark routing and response cleaning across message sizes
+def bench_micro():
+    results = {}
+    for words in (8, 64, 512):
+        message = sized_message(words)
+        reply = " ".join([FAKE_REPLY] * max(1, words // 16))
+        number = max(50, 20000 // words)
+        results[f"{words}Words"] = {
+            "getFeatureLinkUs": time_call(
+                chatbot.get_feature_link, message, "teacher", number=number
+            ),
+            "needsLoginUs": time_call(
+                chatbot.needs_login, message, "guest", number=number
+            ),
+            "cleanResponseUs": time_call(chatbot.clean_response, reply, number=number),
+        }
+    results["cleaning"] = bench_cleaning()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the chatbot service against a fake model"
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="{startup,client,server,store,ordering,transport,micro}",
+        help="benchmarks to run (default: all)",
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="fake model seconds"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--unique", action="store_true", help="make every message miss the cache"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--workers", type=int, default=4, help="forked workers for startup"
+    )
+    parser.add_argument(
+        "--conversations", type=int, default=5000, help="conversations for store"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16, 64],
+        help="thread counts for ordering",
+    )
+    parser.add_argument(
+        "--pool-sizes",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16],
+        help="model connection pool sizes for transport",
+    )
+    args = parser.parse_args()
+    # Startup runs first, so workers are forked before any benchmark threads
+    names = ["startup", "client", "server", "store", "ordering", "transport", "micro"]
+    benchmarks = args.benchmarks or names
+    for name in benchmarks:
+        if name not in names:
+            parser.error(f"unknown benchmark: {name}")
+
+    fake = FakeModels(args.latency, args.error_rate, args.seed)
+    models = chatbot.get_client().models
+    models.generate_content = fake.generate_content
+    models.generate_content_stream = fake.generate_content_stream
+    report = {}
+    for name in benchmarks:
+        if name == "startup":
+            report[name] = bench_startup(args.workers)
+            continue
+        if name == "store":
+            report[name] = bench_store(args.conversations)
+            continue
+        if name == "ordering":
+            report[name] = bench_ordering(args.threads)
+            continue
+        if name == "transport":
+            report[name] = bench_transport(
+                args.pool_sizes, concurrency=args.concurrency
+            )
+            continue
+        if name == "micro":
+            report[name] = bench_micro()
+            continue
+        chatbot.response_cache.clear()
+        chatbot.conversations.clear()
+        requests = chat_requests(args.requests, args.unique, args.seed)
+        run = bench_test_client if name == "client" else bench_server
+        report[name] = run(requests, args.concurrency)
+    report["model"] = {"calls": fake.calls, "injectedErrors": fake.errors}
+    report["servedBy"] = chatbot.served_latency.stats()
+
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class ConversationLocks:
+    """Runs the turns of each conversation one at a time, in arrival order.
+
+    A conversation is held while its key is in its stripe's table, and the
+    turns waiting for it queue behind the holder. Release hands the
+    conversation straight to the oldest waiter, so turns cannot overtake
+    each other. The stripe locks only guard this bookkeeping, so turns of
+    unrelated conversations never wait for each other.
+    """
+
+    def __init__(self, stripes=64, clock=time.perf_counter):
+        self._clock = clock
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # conversation ID -> waiters queued behind the turn holding it
+        self._queues = [{} for _ in range(stripes)]
+        self._stats_lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.max_queue_depth = 0
+
+    def _stripe(self, conversation_id):
+        index = hash(conversation_id) % len(self._locks)
+        return self._locks[index], self._queues[index]
+
+    # Takes the conversation if it is free, otherwise queues `waiter`.
+    # Returns whether the caller has to wait.
+    def _enqueue(self, conversation_id, waiter):
+        lock, queues = self._stripe(conversation_id)
+        with lock:
+            queue = queues.get(conversation_id)
+            if queue is None:
+                queues[conversation_id] = deque()
+            else:
+                queue.append(waiter)
+                depth = len(queue)
+        with self._stats_lock:
+            self.acquired += 1
+            if queue is not None:
+                self.waited += 1
+                self.max_queue_depth = max(self.max_queue_depth, depth)
+        return queue is not None
+
+    def _record_wait(self, started):
+        with self._stats_lock:
+            self.wait_seconds += self._clock() - started
+
+    def acquire(self, conversation_id):
+        waiter = threading.Lock()
+        waiter.acquire()
+        if self._enqueue(conversation_id, waiter):
+            started = self._clock()
+            # Released by the turn ahead when it hands the conversation over
+            waiter.acquire()
+            self._record_wait(started)
+
+    async def acquire_async(self, conversation_id):
+        """Like acquire, but waits without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        if not self._enqueue(conversation_id, waiter):
+            return
+        started = self._clock()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Leave the queue, or pass the conversation on if it was already
+            # handed to this turn
+            lock, queues = self._stripe(conversation_id)
+            with lock:
+                queue = queues[conversation_id]
+                queued = waiter in queue
+                if queued:
+                    queue.remove(waiter)
+            if not queued:
+                self.release(conversation_id)
+            raise
+        self._record_wait(started)
+
+    def release(self, conversation_id):
+        lock, queues = self._stripe(conversation_id)
+        with lock:
+            queue = queues[conversation_id]
+            if not queue:
+                del queues[conversation_id]
+                return
+            waiter = queue.popleft()
+        if isinstance(waiter, asyncio.Future):
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+        else:
+            waiter.release()
+
+    @contextmanager
+    def hold(self, conversation_id):
+        self.acquire(conversation_id)
+        try:
+            yield
+        finally:
+            self.release(conversation_id)
+
+    @asynccontextmanager
+    async def hold_async(self, conversation_id):
+        await self.acquire_async(conversation_id)
+        try:
+            yield
+        finally:
+            self.release(conversation_id)
+
+    def stats(self):
+        held = queued = 0
+        for lock, queues in zip(self._locks, self._queues):
+            with lock:
+                held += len(queues)
+                queued += sum(len(queue) for queue in queues.values())
+        with self._stats_lock:
+            return {
+                "stripes": len(self._locks),
+                "heldConversations": held,
+                "queuedTurns": queued,
+                "maxQueueDepth": self.max_queue_depth,
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "avgWaitMs": (
+                    self.wait_seconds * 1000 / self.waited if self.waited else 0.0
+                ),
+            }
+
+
+def _wake(waiter):
+    # A waiter cancelled after the handover was scheduled passes it on itself
+    if not waiter.done():
+        waiter.set_result(None)
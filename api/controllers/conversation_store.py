@@ -0,0 +1,572 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+try:
+    import redis
+except ImportError:  # Only needed for the redis:// backend
+    redis = None
+
+
+class ConversationStore:
+    """Interface for chat history storage shared by the chatbot routes"""
+
+    def __init__(self, max_messages=10, ttl=3600, max_conversations=10000):
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.max_conversations = max_conversations
+
+    def history(self, conversation_id):
+        """Return the most recent entries for a conversation, oldest first"""
+        raise NotImplementedError
+
+    def append(self, conversation_id, *entries):
+        """Append entries ({"role": ..., "content": ...}) to a conversation in one write"""
+        raise NotImplementedError
+
+    def summary(self, conversation_id):
+        """Return the summary of turns folded out of the history, or an empty string"""
+        return ""
+
+    def fold(self, conversation_id, entries, summary):
+        """Replace the oldest history entries with a summary.
+
+        Nothing changes unless `entries` are still the oldest entries, so a
+        fold computed from a stale read is dropped. Returns whether it applied.
+        """
+        raise NotImplementedError
+
+    def clear(self, conversation_id=None):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+# Roles are stored as one-byte codes, interned in the order first seen
+_roles = ["user", "assistant"]
+_role_codes = {role: code for code, role in enumerate(_roles)}
+
+
+def _role_code(role):
+    code = _role_codes.get(role)
+    if code is None:
+        code = _role_codes[role] = len(_roles)
+        _roles.append(role)
+    return code
+
+
+class _Conversation:
+    """History of one conversation as parallel arrays of role codes and contents.
+
+    While the conversation is compressed, contents is None and packed holds
+    the contents as zlib-compressed JSON.
+    """
+
+    __slots__ = ("last_seen", "roles", "contents", "packed", "summary")
+
+    def __init__(self, last_seen):
+        self.last_seen = last_seen
+        self.roles = bytearray()
+        self.contents = deque()
+        self.packed = None
+        self.summary = ""
+
+
+class MemoryConversationStore(ConversationStore):
+    """In-memory chat history with per-conversation caps, idle expiry and LRU eviction.
+
+    With compress_after set, conversations idle for that many seconds are
+    compressed until they are used again or expire.
+    """
+
+    def __init__(
+        self,
+        max_messages=10,
+        ttl=3600,
+        max_conversations=10000,
+        compress_after=0,
+        clock=time.monotonic,
+    ):
+        super().__init__(max_messages, ttl, max_conversations)
+        self.compress_after = compress_after
+        self._clock = clock
+        self._lock = threading.Lock()
+        # conversation_id -> _Conversation, least recently used first
+        self._conversations = OrderedDict()
+        # Uncompressed conversations in the same order, when compression is on
+        self._warm = OrderedDict()
+        self._content_bytes = 0
+        self._messages = 0
+        self._trimmed = 0
+        self._expired = 0
+        self._evicted = 0
+        self._compressed = 0
+        self._compressed_bytes = 0
+        self._compressions = 0
+
+    def history(self, conversation_id):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            record = self._conversations.get(conversation_id)
+            if record is None:
+                return []
+            self._touch(conversation_id, record, now)
+            return [
+                {"role": _roles[code], "content": content}
+                for code, content in zip(record.roles, record.contents)
+            ]
+
+    def append(self, conversation_id, *entries):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            record = self._conversations.get(conversation_id)
+            if record is None:
+                record = self._conversations[conversation_id] = _Conversation(now)
+            self._touch(conversation_id, record, now)
+
+            for entry in entries:
+                record.roles.append(_role_code(entry["role"]))
+                record.contents.append(entry["content"])
+                self._account(entry["content"], 1)
+            while len(record.contents) > self.max_messages:
+                del record.roles[0]
+                self._account(record.contents.popleft(), -1)
+                self._trimmed += 1
+
+            while len(self._conversations) > self.max_conversations:
+                evicted_id, evicted = self._conversations.popitem(last=False)
+                self._warm.pop(evicted_id, None)
+                self._drop(evicted)
+                self._evicted += 1
+            self._compress_idle(now)
+
+    def summary(self, conversation_id):
+        with self._lock:
+            record = self._conversations.get(conversation_id)
+            return record.summary if record is not None else ""
+
+    def fold(self, conversation_id, entries, summary):
+        with self._lock:
+            record = self._conversations.get(conversation_id)
+            # A compressed conversation has been idle since the fold was
+            # queued, and the next turn queues it again
+            if (
+                record is None
+                or record.contents is None
+                or len(record.roles) < len(entries)
+            ):
+                return False
+            for code, content, entry in zip(record.roles, record.contents, entries):
+                if _roles[code] != entry["role"] or content != entry["content"]:
+                    return False
+            del record.roles[: len(entries)]
+            for _ in entries:
+                self._account(record.contents.popleft(), -1)
+            record.summary = summary
+            return True
+
+    def clear(self, conversation_id=None):
+        with self._lock:
+            if conversation_id is None:
+                self._conversations.clear()
+                self._warm.clear()
+                self._content_bytes = 0
+                self._messages = 0
+                self._compressed = 0
+                self._compressed_bytes = 0
+                return
+            record = self._conversations.pop(conversation_id, None)
+            self._warm.pop(conversation_id, None)
+            if record is not None:
+                self._drop(record)
+
+    def stats(self):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            self._compress_idle(now)
+            return {
+                "backend": "memory",
+                "conversations": len(self._conversations),
+                "messages": self._messages,
+                "contentBytes": self._content_bytes + self._compressed_bytes,
+                "trimmedMessages": self._trimmed,
+                "expiredConversations": self._expired,
+                "evictedConversations": self._evicted,
+                "compressedConversations": self._compressed,
+                "compressedBytes": self._compressed_bytes,
+                "compressions": self._compressions,
+            }
+
+    def _touch(self, conversation_id, record, now):
+        record.last_seen = now
+        self._conversations.move_to_end(conversation_id)
+        self._decompress(record)
+        if self.compress_after:
+            self._warm[conversation_id] = None
+            self._warm.move_to_end(conversation_id)
+
+    def _expire(self, now):
+        # Entries are kept in access order, so expired ones are always at the front
+        if not self.ttl:
+            return
+        while self._conversations:
+            conversation_id, record = next(iter(self._conversations.items()))
+            if now - record.last_seen < self.ttl:
+                break
+            del self._conversations[conversation_id]
+            self._warm.pop(conversation_id, None)
+            self._drop(record)
+            self._expired += 1
+
+    def _compress_idle(self, now):
+        # Same order as the conversations, so idle ones are at the front too
+        if not self.compress_after:
+            return
+        while self._warm:
+            conversation_id = next(iter(self._warm))
+            record = self._conversations[conversation_id]
+            if now - record.last_seen < self.compress_after:
+                break
+            del self._warm[conversation_id]
+            size = sum(sys.getsizeof(content) for content in record.contents)
+            packed = zlib.compress(
+                json.dumps(list(record.contents), ensure_ascii=False).encode("utf-8")
+            )
+            # Short conversations can come out larger than they went in
+            if sys.getsizeof(packed) >= size:
+                continue
+            self._content_bytes -= size
+            record.packed = packed
+            record.contents = None
+            self._compressed += 1
+            self._compressed_bytes += sys.getsizeof(record.packed)
+            self._compressions += 1
+
+    def _decompress(self, record):
+        if record.contents is not None:
+            return
+        record.contents = deque(json.loads(zlib.decompress(record.packed)))
+        self._compressed -= 1
+        self._compressed_bytes -= sys.getsizeof(record.packed)
+        record.packed = None
+        for content in record.contents:
+            self._content_bytes += sys.getsizeof(content)
+
+    def _drop(self, record):
+        if record.contents is None:
+            self._messages -= len(record.roles)
+            self._compressed -= 1
+            self._compressed_bytes -= sys.getsizeof(record.packed)
+            return
+        for content in record.contents:
+            self._account(content, -1)
+
+    def _account(self, content, sign):
+        self._messages += sign
+        self._content_bytes += sign * sys.getsizeof(content)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Append-only chat history in a SQLite WAL file shared by workers on one host"""
+
+    def __init__(
+        self,
+        path,
+        max_messages=10,
+        ttl=3600,
+        max_conversations=10000,
+        prune_interval=60,
+        clock=time.time,
+    ):
+        super().__init__(max_messages, ttl, max_conversations)
+        self.path = path
+        self.prune_interval = prune_interval
+        self._clock = clock
+        self._local = threading.local()
+        self._prune_lock = threading.Lock()
+        self._next_prune = 0
+
+        # The schema is created on a connection of its own, so a server that
+        # imports the app before forking does not hand one to every worker
+        db = sqlite3.connect(self.path, timeout=5)
+        with db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    conversation_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+                """)
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS messages_conversation "
+                "ON messages (conversation_id, id)"
+            )
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS summaries (
+                    conversation_id TEXT PRIMARY KEY,
+                    content TEXT NOT NULL
+                )
+                """)
+        db.close()
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def history(self, conversation_id):
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT role, content, created FROM messages "
+                "WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, self.max_messages),
+            )
+            .fetchall()
+        )
+        # An idle conversation is expired even if pruning has not caught up yet
+        if not rows or (self.ttl and self._clock() - rows[0][2] >= self.ttl):
+            return []
+        return [{"role": role, "content": content} for role, content, _ in rows[::-1]]
+
+    def append(self, conversation_id, *entries):
+        now = self._clock()
+        with self._connect() as db:
+            db.executemany(
+                "INSERT INTO messages (conversation_id, role, content, created) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (conversation_id, entry["role"], entry["content"], now)
+                    for entry in entries
+                ],
+            )
+        self._maybe_prune(now)
+
+    def summary(self, conversation_id):
+        row = (
+            self._connect()
+            .execute(
+                # Like history, an idle conversation's summary is expired
+                "SELECT content FROM summaries WHERE conversation_id = ? AND ("
+                "SELECT MAX(created) FROM messages WHERE conversation_id = ?) > ?",
+                (
+                    conversation_id,
+                    conversation_id,
+                    self._clock() - self.ttl if self.ttl else float("-inf"),
+                ),
+            )
+            .fetchone()
+        )
+        return row[0] if row else ""
+
+    def fold(self, conversation_id, entries, summary):
+        with self._connect() as db:
+            # Compared against the same capped window history returns, since
+            # rows past the cap stay in the table until the next prune
+            rows = db.execute(
+                "SELECT id, role, content FROM ("
+                "SELECT id, role, content FROM messages "
+                "WHERE conversation_id = ? ORDER BY id DESC LIMIT ?"
+                ") ORDER BY id LIMIT ?",
+                (conversation_id, self.max_messages, len(entries)),
+            ).fetchall()
+            if not rows or [
+                {"role": role, "content": content} for _, role, content in rows
+            ] != [
+                {"role": entry["role"], "content": entry["content"]}
+                for entry in entries
+            ]:
+                return False
+            # Rows before the window were never in the history, so they go too
+            db.execute(
+                "DELETE FROM messages WHERE conversation_id = ? AND id <= ?",
+                (conversation_id, rows[-1][0]),
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO summaries (conversation_id, content) "
+                "VALUES (?, ?)",
+                (conversation_id, summary),
+            )
+        return True
+
+    def clear(self, conversation_id=None):
+        with self._connect() as db:
+            if conversation_id is None:
+                db.execute("DELETE FROM messages")
+                db.execute("DELETE FROM summaries")
+            else:
+                db.execute(
+                    "DELETE FROM messages WHERE conversation_id = ?",
+                    (conversation_id,),
+                )
+                db.execute(
+                    "DELETE FROM summaries WHERE conversation_id = ?",
+                    (conversation_id,),
+                )
+
+    def prune(self, now=None):
+        """Drop expired conversations, messages past the cap and least recent conversations"""
+        now = self._clock() if now is None else now
+        with self._connect() as db:
+            if self.ttl:
+                db.execute(
+                    "DELETE FROM messages WHERE conversation_id IN ("
+                    "SELECT conversation_id FROM messages "
+                    "GROUP BY conversation_id HAVING MAX(created) < ?)",
+                    (now - self.ttl,),
+                )
+            db.execute(
+                "DELETE FROM messages WHERE id IN ("
+                "SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+                "PARTITION BY conversation_id ORDER BY id DESC) AS position "
+                "FROM messages) WHERE position > ?)",
+                (self.max_messages,),
+            )
+            db.execute(
+                "DELETE FROM messages WHERE conversation_id IN ("
+                "SELECT conversation_id FROM messages GROUP BY conversation_id "
+                "ORDER BY MAX(id) DESC LIMIT -1 OFFSET ?)",
+                (self.max_conversations,),
+            )
+            db.execute(
+                "DELETE FROM summaries WHERE conversation_id NOT IN ("
+                "SELECT DISTINCT conversation_id FROM messages)"
+            )
+
+    def _maybe_prune(self, now):
+        # Pruning is a maintenance step, so only one thread per worker runs it
+        if now < self._next_prune or not self._prune_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_prune = now + self.prune_interval
+            self.prune(now)
+        finally:
+            self._prune_lock.release()
+
+    def stats(self):
+        conversations, messages, content_bytes = (
+            self._connect()
+            .execute(
+                "SELECT COUNT(DISTINCT conversation_id), COUNT(*), "
+                "COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM messages"
+            )
+            .fetchone()
+        )
+        return {
+            "backend": "sqlite",
+            "conversations": conversations,
+            "messages": messages,
+            "contentBytes": content_bytes,
+        }
+
+
+class RedisConversationStore(ConversationStore):
+    """Chat history in Redis lists, shared by every worker and instance"""
+
+    def __init__(
+        self,
+        url,
+        max_messages=10,
+        ttl=3600,
+        max_conversations=10000,
+        prefix="chatbot:conversation:",
+    ):
+        if redis is None:
+            raise RuntimeError("The redis package is required for a redis:// store")
+        super().__init__(max_messages, ttl, max_conversations)
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    # Conversation IDs come from clients, so messages and summaries live under
+    # separate namespaces that no ID can reach across
+    def _messages_key(self, conversation_id):
+        return self.prefix + "msg:" + conversation_id
+
+    def _summary_key(self, conversation_id):
+        return self.prefix + "sum:" + conversation_id
+
+    def history(self, conversation_id):
+        entries = self._redis.lrange(self._messages_key(conversation_id), 0, -1)
+        return [json.loads(entry) for entry in entries]
+
+    def append(self, conversation_id, *entries):
+        # One round trip: push, trim to the cap and refresh the idle expiry.
+        # The conversation count is bounded by the server's maxmemory policy.
+        key = self._messages_key(conversation_id)
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.rpush(key, *[json.dumps(entry) for entry in entries])
+        pipeline.ltrim(key, -self.max_messages, -1)
+        if self.ttl:
+            pipeline.expire(key, int(self.ttl))
+            pipeline.expire(self._summary_key(conversation_id), int(self.ttl))
+        pipeline.execute()
+
+    def summary(self, conversation_id):
+        summary = self._redis.get(self._summary_key(conversation_id))
+        return summary.decode("utf-8") if summary else ""
+
+    def fold(self, conversation_id, entries, summary):
+        key = self._messages_key(conversation_id)
+        with self._redis.pipeline() as pipeline:
+            # An append from any worker can trim the list between the check
+            # and the trim, so the trim only applies if the list is unchanged
+            try:
+                pipeline.watch(key)
+                oldest = pipeline.lrange(key, 0, len(entries) - 1)
+                if [json.loads(entry) for entry in oldest] != list(entries):
+                    return False
+                pipeline.multi()
+                pipeline.ltrim(key, len(entries), -1)
+                pipeline.set(self._summary_key(conversation_id), summary)
+                if self.ttl:
+                    pipeline.expire(self._summary_key(conversation_id), int(self.ttl))
+                pipeline.execute()
+            except redis.WatchError:
+                # The next turn queues the fold again from a fresh read
+                return False
+        return True
+
+    def clear(self, conversation_id=None):
+        if conversation_id is not None:
+            self._redis.delete(
+                self._messages_key(conversation_id),
+                self._summary_key(conversation_id),
+            )
+            return
+        for key in self._redis.scan_iter(match=self.prefix + "*"):
+            self._redis.delete(key)
+
+    def stats(self):
+        info = self._redis.info("memory")
+        return {"backend": "redis", "usedMemoryBytes": info.get("used_memory", 0)}
+
+
+def create_conversation_store(url=None, compress_after=0, **limits):
+    """Create a store from a URL: memory (default), sqlite:///path or redis://host"""
+    url = url or "memory"
+    if url == "memory":
+        return MemoryConversationStore(compress_after=compress_after, **limits)
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///") :]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return SQLiteConversationStore(path, **limits)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisConversationStore(url, **limits)
+    raise ValueError(f"Unsupported conversation store URL: {url}")
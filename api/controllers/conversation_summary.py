@@ -0,0 +1,72 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def local_summary(summary, entries, max_chars=800):
+    """Deterministic summarizer that keeps the user's earlier questions, newest last"""
+    lines = [summary] if summary else []
+    for entry in entries:
+        if entry["role"] == "user":
+            lines.append(f"User asked: {' '.join(entry['content'].split())[:120]}")
+    text = "\n".join(lines)
+    # Keep the most recent part when the summary outgrows its budget
+    if len(text) > max_chars:
+        text = text[-max_chars:].split("\n", 1)[-1]
+    return text
+
+
+class RollingSummarizer:
+    """Folds older conversation turns into the store's summary on background threads"""
+
+    def __init__(self, store, summarize, max_workers=1):
+        self.store = store
+        self.summarize = summarize
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="chatbot-summary"
+        )
+        self._lock = threading.Lock()
+        # Conversations with a fold queued or running, so each is folded once at a time
+        self._pending = set()
+        self.folded = 0
+        self.stale = 0
+        self.failed = 0
+
+    def submit(self, conversation_id, entries):
+        """Queue the oldest `entries` of a conversation to be folded into its summary"""
+        if not entries:
+            return None
+        with self._lock:
+            if conversation_id in self._pending:
+                return None
+            self._pending.add(conversation_id)
+        return self._executor.submit(self._fold, conversation_id, list(entries))
+
+    def _fold(self, conversation_id, entries):
+        try:
+            summary = self.summarize(self.store.summary(conversation_id), entries)
+            folded = self.store.fold(conversation_id, entries, summary)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._pending.discard(conversation_id)
+        with self._lock:
+            if folded:
+                self.folded += 1
+            else:
+                self.stale += 1
+        return folded
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "folded": self.folded,
+                "stale": self.stale,
+                "failed": self.failed,
+            }
@@ -0,0 +1,72 @@
+# Production server for the chatbot:
+#
+#   gunicorn --config api/controllers/gunicorn.conf.py
+#
+# The app is imported once in the master (preload_app), so the routing tables,
+# prompt headers and FAQ answers are built before forking and shared by all
+# workers. Each worker then creates its own Gemini client and opens its model
+# connections before taking requests.
+# CHATBOT_WORKER_CLASS=asgi serves chatbot_asgi with uvicorn workers instead.
+import gc
+import multiprocessing
+import os
+import time
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = f"{os.getenv('CHATBOT_HOST', '0.0.0.0')}:{os.getenv('PORT', '5000')}"
+workers = int(
+    os.getenv("CHATBOT_WORKERS", str(min(multiprocessing.cpu_count() * 2 + 1, 8)))
+)
+preload_app = True
+
+if os.getenv("CHATBOT_WORKER_CLASS", "gthread") == "asgi":
+    wsgi_app = "chatbot_asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "chatbot:create_app()"
+    worker_class = "gthread"
+    # Threads per worker; requests mostly wait on Gemini
+    threads = int(os.getenv("CHATBOT_THREADS", "8"))
+
+# Longer than a model call with retries (CHATBOT_MODEL_DEADLINE)
+timeout = int(os.getenv("CHATBOT_WORKER_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+
+_started = time.perf_counter()
+
+
+def when_ready(server):
+    # Everything the preload allocated is never collected, so keep the
+    # collector from touching those pages and unsharing them in the workers
+    gc.freeze()
+    server.log.info(
+        "Preloaded %s in %.2fs (%d objects frozen)",
+        wsgi_app,
+        time.perf_counter() - _started,
+        gc.get_freeze_count(),
+    )
+
+
+def post_worker_init(worker):
+    import chatbot
+    from metrics import rss_bytes
+
+    # Create this worker's Gemini client now rather than on its first request.
+    # A gthread worker also opens its model connections here; an ASGI worker
+    # opens them from the app's lifespan startup.
+    chatbot.get_client()
+    if worker_class == "gthread":
+        chatbot.warm_model_client()
+        worker.log.info(
+            "Worker %s opened %d model connections in %.2fs",
+            worker.pid,
+            chatbot.warmed_connections,
+            chatbot.warm_seconds,
+        )
+    worker.log.info(
+        "Worker %s ready, client created in %.2fs, %.1f MB resident",
+        worker.pid,
+        chatbot.client_seconds,
+        rss_bytes() / 2**20,
+    )
@@ -0,0 +1,169 @@
+import os
+import re
+import resource
+import threading
+import uuid
+
+
+# Function to read the resident set size of this process in bytes
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current size where /proc is not available
+        scale = 1 if os.uname().sysname == "Darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class LatencyCounters:
+    """Request count and latency totals per label, e.g. per serving path"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # label -> [count, total seconds, max seconds]
+        self._counters = {}
+
+    def record(self, label, seconds):
+        with self._lock:
+            counter = self._counters.setdefault(label, [0, 0.0, 0.0])
+            counter[0] += 1
+            counter[1] += seconds
+            counter[2] = max(counter[2], seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                label: {
+                    "count": count,
+                    "avgMs": total * 1000 / count,
+                    "maxMs": peak * 1000,
+                }
+                for label, (count, total, peak) in self._counters.items()
+            }
+
+
+# Upper bounds in seconds, from local routing (sub-millisecond) to model calls
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+
+def _labels(label, value):
+    return f'{{{label}="{value}"}}' if label else ""
+
+
+class Histogram:
+    """Prometheus histogram with one series per value of a single label"""
+
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label value -> [count per bucket..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, value, seconds):
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for value, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(
+                        f'{self.name}_bucket{{{self.label}="{value}",le="{bound}"}} {count}'
+                    )
+                lines.append(
+                    f'{self.name}_bucket{{{self.label}="{value}",le="+Inf"}} {series[-2]}'
+                )
+                lines.append(
+                    f"{self.name}_count{_labels(self.label, value)} {series[-2]}"
+                )
+                lines.append(
+                    f"{self.name}_sum{_labels(self.label, value)} {series[-1]}"
+                )
+        return lines
+
+
+class Counter:
+    """Prometheus counter, optionally with one series per value of a single label"""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, value=None, amount=1):
+        with self._lock:
+            self._values[value] = self._values.get(value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for value, count in sorted(
+                self._values.items(), key=lambda item: str(item[0])
+            ):
+                lines.append(f"{self.name}{_labels(self.label, value)} {count}")
+        return lines
+
+
+def render_sample(name, help, value, label=None, kind="gauge"):
+    """Render a metric read from elsewhere, e.g. a stats() dict.
+
+    value is a number, or {label value: number} when label is set.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    values = value if label else {None: value}
+    for label_value, number in values.items():
+        lines.append(f"{name}{_labels(label, label_value)} {float(number)}")
+    return lines
+
+
+_trace_id_pattern = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+
+class Trace:
+    """Trace ID and per-stage timings of one request"""
+
+    __slots__ = ("trace_id", "timings")
+
+    def __init__(self, trace_id=None):
+        # A caller's ID is reused only if it is safe to echo back in a header
+        if not trace_id or not _trace_id_pattern.fullmatch(trace_id):
+            trace_id = uuid.uuid4().hex
+        self.trace_id = trace_id
+        # stage -> seconds, in the order the stages ran
+        self.timings = {}
+
+    def server_timing(self):
+        """Stage timings as a Server-Timing header value"""
+        return ", ".join(
+            f"{stage};dur={seconds * 1000:.2f}"
+            for stage, seconds in self.timings.items()
+        )
@@ -0,0 +1,290 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+
+class ModelUnavailable(Exception):
+    """The model was not called: the breaker is open or the rate limit was not met in time"""
+
+
+class TokenBucket:
+    """Client-side rate limiter that slows down when the provider throttles.
+
+    Tokens refill at `rate` per second up to `burst`. A 429 halves the rate
+    and each success adds back a small step until the configured rate is
+    reached again.
+    """
+
+    def __init__(self, rate, burst, min_rate=None, clock=time.monotonic):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 32
+        self.burst = burst
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = clock()
+        self.granted = 0
+        self.rejected = 0
+        self.throttled = 0
+
+    def _take(self):
+        # Returns 0 when a token was taken, otherwise the seconds until one is due
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self.granted += 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout):
+        """Wait up to `timeout` seconds for a token, return whether one was taken"""
+        deadline = self._clock() + timeout
+        while True:
+            with self._lock:
+                wait = self._take()
+                if wait and self._clock() + wait > deadline:
+                    self.rejected += 1
+                    return False
+            if not wait:
+                return True
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout):
+        """Like acquire, but waits without blocking the event loop"""
+        deadline = self._clock() + timeout
+        while True:
+            with self._lock:
+                wait = self._take()
+                if wait and self._clock() + wait > deadline:
+                    self.rejected += 1
+                    return False
+            if not wait:
+                return True
+            await asyncio.sleep(wait)
+
+    def throttle(self):
+        """The provider returned 429: halve the rate"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.throttled += 1
+
+    def recover(self):
+        """A call succeeded: step the rate back towards the configured one"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ratePerSecond": self.rate,
+                "maxRatePerSecond": self.max_rate,
+                "burst": self.burst,
+                "tokens": self._tokens,
+                "granted": self.granted,
+                "rejected": self.rejected,
+                "throttled": self.throttled,
+            }
+
+
+class CircuitBreaker:
+    """Stops calling the model while its recent error rate is above a threshold.
+
+    The breaker opens when at least `min_calls` of the last `window` calls
+    were recorded and the share of failures reaches `threshold`. After
+    `cooldown` seconds it lets one trial call through (half-open); the trial
+    closes the breaker on success and reopens it on failure.
+    """
+
+    def __init__(
+        self, threshold=0.5, window=20, min_calls=10, cooldown=30, clock=time.monotonic
+    ):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)
+        self.state = "closed"
+        self._opened_at = 0
+        self._trial_at = 0
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Return whether a call may go ahead"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = self._clock()
+            if self.state == "open" and now - self._opened_at >= self.cooldown:
+                self.state = "halfOpen"
+                self._trial_at = now
+                return True
+            # A trial that never reported back is replaced after another cooldown
+            if self.state == "halfOpen" and now - self._trial_at >= self.cooldown:
+                self._trial_at = now
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, success):
+        with self._lock:
+            if self.state == "halfOpen":
+                if success:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (
+                self.state == "closed"
+                and len(self._outcomes) >= self.min_calls
+                and failures >= self.threshold * len(self._outcomes)
+            ):
+                self._open()
+
+    def _open(self):
+        self.state = "open"
+        self._opened_at = self._clock()
+        self._outcomes.clear()
+        self.opened += 1
+
+    def stats(self):
+        with self._lock:
+            calls = len(self._outcomes)
+            return {
+                "state": self.state,
+                "errorRate": self._outcomes.count(False) / calls if calls else 0.0,
+                "threshold": self.threshold,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+class _Waiter:
+    __slots__ = ("signal", "admitted")
+
+    def __init__(self, signal):
+        # threading.Event, or an asyncio future for async callers
+        self.signal = signal
+        self.admitted = False
+
+
+class AdmissionController:
+    """Admits at most `slots` requests at a time, the most important first.
+
+    Requests queue by priority, 0 being the highest, and in arrival order
+    within a priority. A finished request hands its slot straight to the
+    first waiter of the highest priority. Each priority has its own queue
+    limit and queue-time deadline; a request whose queue is full, or that
+    is still queued at its deadline, is shed.
+    """
+
+    def __init__(self, slots, max_queued, deadlines, clock=time.monotonic):
+        self.slots = slots
+        self.max_queued = max_queued
+        self.deadlines = deadlines
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queues = [deque() for _ in max_queued]
+        self.admitted = [0] * len(max_queued)
+        self.shed = [0] * len(max_queued)
+        self.wait_seconds = [0.0] * len(max_queued)
+
+    # Takes a slot, or queues a waiter with `signal`. Returns True when
+    # admitted, False when shed, or the queued waiter.
+    def _enter(self, priority, signal):
+        with self._lock:
+            if self._active < self.slots:
+                self._active += 1
+                self.admitted[priority] += 1
+                return True
+            queue = self._queues[priority]
+            if len(queue) >= self.max_queued[priority]:
+                self.shed[priority] += 1
+                return False
+            waiter = _Waiter(signal)
+            queue.append(waiter)
+            return waiter
+
+    # Settles a waiter whose wait ended, returning whether it was admitted
+    def _leave(self, priority, waiter, started):
+        with self._lock:
+            self.wait_seconds[priority] += self._clock() - started
+            if waiter.admitted:
+                self.admitted[priority] += 1
+                return True
+            self._queues[priority].remove(waiter)
+            self.shed[priority] += 1
+            return False
+
+    def acquire(self, priority):
+        """Wait for a slot up to the priority's deadline, return whether one was taken"""
+        waiter = self._enter(priority, threading.Event())
+        if not isinstance(waiter, _Waiter):
+            return waiter
+        started = self._clock()
+        waiter.signal.wait(self.deadlines[priority])
+        return self._leave(priority, waiter, started)
+
+    async def acquire_async(self, priority):
+        """Like acquire, but waits without blocking the event loop"""
+        waiter = self._enter(priority, asyncio.get_running_loop().create_future())
+        if not isinstance(waiter, _Waiter):
+            return waiter
+        started = self._clock()
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(waiter.signal), self.deadlines[priority]
+            )
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Pass on a slot handed over while the caller went away
+            if self._leave(priority, waiter, started):
+                self.release()
+            raise
+        return self._leave(priority, waiter, started)
+
+    def release(self):
+        with self._lock:
+            for queue in self._queues:
+                if queue:
+                    waiter = queue.popleft()
+                    waiter.admitted = True
+                    break
+            else:
+                self._active -= 1
+                return
+        if isinstance(waiter.signal, asyncio.Future):
+            waiter.signal.get_loop().call_soon_threadsafe(_wake, waiter.signal)
+        else:
+            waiter.signal.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "active": self._active,
+                "queueDepth": [len(queue) for queue in self._queues],
+                "admitted": list(self.admitted),
+                "shed": list(self.shed),
+                "avgWaitMs": [
+                    seconds * 1000 / (admitted + shed) if admitted + shed else 0.0
+                    for seconds, admitted, shed in zip(
+                        self.wait_seconds, self.admitted, self.shed
+                    )
+                ],
+            }
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,96 @@
+import threading
+
+from metrics import LatencyCounters
+
+
+class ModelRouter:
+    """Picks the model tier for each query from how complex it looks.
+
+    A query scores a point each for being long, being very long, following
+    earlier turns in its conversation, referring back to them, and matching
+    no feature in the routing tables. Queries scoring at most lite_max_score
+    go to the lite tier, the rest to the full tier. Clear navigation
+    questions never get here: they are answered from a local template.
+
+    With hedge_after set, a full tier call still running after that many
+    seconds is also sent to the lite tier, and whichever answers first wins.
+    """
+
+    def __init__(
+        self,
+        full_model,
+        lite_model=None,
+        lite_max_score=1,
+        long_words=12,
+        very_long_words=40,
+        hedge_after=0,
+    ):
+        self.models = {"full": full_model, "lite": lite_model or full_model}
+        self.lite_enabled = bool(lite_model) and lite_model != full_model
+        self.lite_max_score = lite_max_score
+        self.long_words = long_words
+        self.very_long_words = very_long_words
+        self.hedge_after = hedge_after
+        self._lock = threading.Lock()
+        # Usage and latency per tier: local, lite or full
+        self.latency = LatencyCounters()
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def score(self, words, history_depth, follow_up, matched):
+        score = 0
+        if words > self.long_words:
+            score += 1
+        if words > self.very_long_words:
+            score += 1
+        # At least one earlier exchange
+        if history_depth >= 2:
+            score += 1
+        if follow_up:
+            score += 1
+        if not matched:
+            score += 1
+        return score
+
+    def route(self, words, history_depth, follow_up, matched):
+        """Return the tier for a query: lite or full"""
+        if not self.lite_enabled:
+            return "full"
+        if self.score(words, history_depth, follow_up, matched) <= self.lite_max_score:
+            return "lite"
+        return "full"
+
+    def model(self, tier):
+        return self.models[tier]
+
+    def hedge_tier(self, tier):
+        """Return the tier to hedge a call on `tier` with, or None"""
+        if tier == "full" and self.lite_enabled and self.hedge_after > 0:
+            return "lite"
+        return None
+
+    def record(self, tier, seconds):
+        self.latency.record(tier, seconds)
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedged += 1
+
+    def record_hedge_win(self):
+        """The hedge answered before the primary call"""
+        with self._lock:
+            self.hedge_wins += 1
+
+    def stats(self):
+        with self._lock:
+            hedged, hedge_wins = self.hedged, self.hedge_wins
+        return {
+            "models": (
+                self.models if self.lite_enabled else {"full": self.models["full"]}
+            ),
+            "liteMaxScore": self.lite_max_score,
+            "hedgeAfterSeconds": self.hedge_after,
+            "hedged": hedged,
+            "hedgeWins": hedge_wins,
+            "tiers": self.latency.stats(),
+        }
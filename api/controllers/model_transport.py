@@ -0,0 +1,118 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from google import genai
+from google.genai import types
+
+try:
+    import h2
+except ImportError:  # Only needed for HTTP/2 model connections
+    h2 = None
+
+
+# Function to cap a request's connect and read timeouts. Shorter ones, e.g.
+# from a request deadline, are kept.
+def _cap_timeouts(request, connect, read):
+    timeout = dict(request.extensions.get("timeout", {}))
+    for phase, limit in (("connect", connect), ("read", read)):
+        current = timeout.get(phase)
+        timeout[phase] = limit if current is None else min(current, limit)
+    request.extensions["timeout"] = timeout
+
+
+class _Transport(httpx.HTTPTransport):
+    """Connection pool that caps the connect and read timeouts of every request"""
+
+    def __init__(self, connect_timeout, read_timeout, **options):
+        super().__init__(**options)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def handle_request(self, request):
+        _cap_timeouts(request, self.connect_timeout, self.read_timeout)
+        return super().handle_request(request)
+
+
+class _AsyncTransport(httpx.AsyncHTTPTransport):
+    """Async counterpart of _Transport"""
+
+    def __init__(self, connect_timeout, read_timeout, **options):
+        super().__init__(**options)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    async def handle_async_request(self, request):
+        _cap_timeouts(request, self.connect_timeout, self.read_timeout)
+        return await super().handle_async_request(request)
+
+
+def create_model_client(
+    api_key,
+    max_connections=100,
+    max_keepalive=20,
+    keepalive_expiry=60,
+    http2=False,
+    connect_timeout=5,
+    read_timeout=30,
+    base_url=None,
+):
+    """Create a GenAI client with its own blocking and async connection pools.
+
+    Idle connections are kept for `keepalive_expiry` seconds, up to
+    `max_keepalive` of them, so steady traffic reuses them instead of
+    paying TCP and TLS setup again. With http2, concurrent calls share
+    multiplexed connections. `base_url` points the client at another
+    endpoint, e.g. a local fake model server.
+    """
+    if http2 and h2 is None:
+        raise RuntimeError("The h2 package is required for HTTP/2 model connections")
+    options = {
+        "connect_timeout": connect_timeout,
+        "read_timeout": read_timeout,
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        ),
+    }
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            base_url=base_url or None,
+            httpx_client=httpx.Client(transport=_Transport(**options), timeout=timeout),
+            httpx_async_client=httpx.AsyncClient(
+                transport=_AsyncTransport(**options), timeout=timeout
+            ),
+        ),
+    )
+
+
+# Function to open `connections` pooled connections to the model endpoint by
+# fetching the model's metadata concurrently. Returns how many succeeded.
+def warm_connections(client, model, connections):
+    if connections <= 0:
+        return 0
+
+    def fetch(_):
+        try:
+            client.models.get(model=model)
+            return True
+        except Exception:
+            return False
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        return sum(executor.map(fetch, range(connections)))
+
+
+# Async counterpart of warm_connections, for the async client's pool
+async def warm_connections_async(client, model, connections):
+    if connections <= 0:
+        return 0
+    results = await asyncio.gather(
+        *[client.aio.models.get(model=model) for _ in range(connections)],
+        return_exceptions=True,
+    )
+    return sum(1 for result in results if not isinstance(result, BaseException))
@@ -0,0 +1,203 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the semantic cache
+    np = None
+
+_punctuation = re.compile(r"[^\w\s']+")
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_message(message):
+    """Lowercase a message and drop punctuation and repeated whitespace"""
+    message = _punctuation.sub(" ", message.lower())
+    return _whitespace.sub(" ", message).strip()
+
+
+def history_fingerprint(history, turns):
+    """Short digest of the last `turns` history entries, empty when turns is 0"""
+    if turns <= 0 or not history:
+        return ""
+    digest = hashlib.blake2b(digest_size=8)
+    for entry in history[-turns:]:
+        digest.update(entry["role"].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(entry["content"].encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of model replies with a TTL and hit/miss counters"""
+
+    def __init__(self, max_entries=2048, ttl=900, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (stored_at, value), least recently used first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evicted = 0
+        self.expired = 0
+        self.warmed = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and self.ttl and self._clock() - item[0] >= self.ttl:
+                del self._entries[key]
+                self.expired += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def warm(self, key, value):
+        """Store a precomputed reply that never expires, though it can still be evicted"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (float("inf"), value)
+            self._entries.move_to_end(key)
+            self.warmed += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def bypass(self):
+        """Count a lookup that was skipped because the answer depends on context"""
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": self.hits / lookups if lookups else 0.0,
+                "bypassed": self.bypassed,
+                "evicted": self.evicted,
+                "expired": self.expired,
+                "warmed": self.warmed,
+            }
+
+
+def hashed_ngram_embedding(text, dimensions=512, n=3):
+    """Deterministic offline embedding from hashed character n-grams"""
+    if np is None:
+        raise RuntimeError("numpy is required for the semantic cache")
+    vector = np.zeros(dimensions, dtype=np.float32)
+    text = f" {normalize_message(text)} "
+    for start in range(max(len(text) - n + 1, 1)):
+        gram = text[start : start + n].encode("utf-8")
+        bucket = int.from_bytes(hashlib.blake2b(gram, digest_size=4).digest(), "big")
+        vector[bucket % dimensions] += 1.0
+    return vector
+
+
+class SemanticCache:
+    """Nearest-neighbour reply cache over message embeddings, one matrix per bucket.
+
+    Each bucket (a role and feature) keeps unit-length embeddings in a float32 matrix that
+    grows up to max_entries rows and then overwrites the oldest row. A lookup
+    is a single matrix-vector product.
+    """
+
+    def __init__(self, embed, threshold=0.9, max_entries=1024):
+        if np is None:
+            raise RuntimeError("numpy is required for the semantic cache")
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # bucket -> [matrix, values, rows used, next row to write]
+        self._buckets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def vector(self, message):
+        """Unit-length embedding of a message, or None if it has no features"""
+        vector = np.asarray(self.embed(message), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def get(self, bucket, vector):
+        if vector is None:
+            return None
+        with self._lock:
+            entry = self._buckets.get(bucket)
+            if entry is not None and entry[2]:
+                scores = entry[0][: entry[2]] @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    return entry[1][best]
+            self.misses += 1
+            return None
+
+    def put(self, bucket, vector, value):
+        if vector is None:
+            return
+        with self._lock:
+            entry = self._buckets.get(bucket)
+            if entry is None:
+                matrix = np.zeros(
+                    (min(16, self.max_entries), vector.shape[0]), np.float32
+                )
+                entry = self._buckets[bucket] = [matrix, [], 0, 0]
+            matrix, values, used, row = entry
+            if row == len(matrix) < self.max_entries:
+                # Grow geometrically until the bucket reaches max_entries
+                size = min(len(matrix) * 2, self.max_entries)
+                matrix = entry[0] = np.resize(matrix, (size, matrix.shape[1]))
+            matrix[row] = vector
+            if row < len(values):
+                values[row] = value
+            else:
+                values.append(value)
+            entry[2] = max(used, row + 1)
+            entry[3] = (row + 1) % self.max_entries
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "buckets": len(self._buckets),
+                "entries": sum(entry[2] for entry in self._buckets.values()),
+                "matrixBytes": sum(entry[0].nbytes for entry in self._buckets.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": self.hits / lookups if lookups else 0.0,
+                "threshold": self.threshold,
+            }
@@ -0,0 +1,47 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Shares one in-flight call per key between concurrent requests.
+
+    The first caller for a key becomes the leader, makes the call and passes
+    its result to finish(). Callers joining while it runs get the leader's
+    future instead of making their own call. A key of None is never shared.
+    """
+
+    def __init__(self, future_factory=Future):
+        self._future_factory = future_factory
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def join(self, key):
+        """Return (future, leader); only the leader should make the call"""
+        if key is None:
+            return None, True
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._flights[key] = self._future_factory()
+            self.calls += 1
+            return future, True
+
+    def finish(self, key, result):
+        """Publish the leader's result (None on failure) to every caller that joined"""
+        if key is None:
+            return
+        with self._lock:
+            future = self._flights.pop(key)
+        future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "inFlight": len(self._flights),
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,254 @@
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+try:
+    import jwt
+except ImportError:  # Only needed for answers from student records
+    jwt = None
+
+try:
+    from bson import ObjectId
+    from bson.errors import InvalidId
+    from pymongo import MongoClient
+except ImportError:  # Only needed for answers from student records
+    MongoClient = None
+
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+
+# Collections behind the Mongoose models in api/models
+PARENTS = "parents"
+TEACHERS = "teachers"
+STUDENTS = "students"
+CLASSES = "classmodels"
+ATTENDANCE = "attendancemodels"
+MARKS = "marksmodels"
+FEE_PAYMENTS = "feepayments"
+
+# Caller of a request, from the token auth.js issued at login
+Identity = namedtuple("Identity", ["role", "user_id"])
+
+
+# Function to read the caller from an "Authorization: Bearer <token>" header.
+# Returns None unless the token is signed with `secret` and has not expired.
+def verify_token(authorization, secret):
+    if jwt is None or not secret or not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme != "Bearer" or not token:
+        return None
+    try:
+        claims = jwt.decode(token, secret, algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return None
+    if not claims.get("role") or not claims.get("id"):
+        return None
+    return Identity(claims["role"].lower(), str(claims["id"]))
+
+
+# Function to check whether tokens signed with `secret` can be verified
+def token_auth_enabled(secret):
+    return jwt is not None and bool(secret)
+
+
+# Function to connect to the MongoDB database named in `url`. Like Mongoose,
+# which the API server uses with the same URL, it falls back to "test" when
+# the URL names no database.
+def mongo_database(url, pool_size=10):
+    if MongoClient is None:
+        raise RuntimeError("The pymongo package is required for student data")
+    return MongoClient(url, maxPoolSize=pool_size).get_default_database("test")
+
+
+class StudentData:
+    """Read-through cache of per-student figures from the EMIS database.
+
+    Answers attendance, latest marks and pending fees for the students a
+    parent or teacher may see, using the same collections and access rules
+    as the dashboard endpoints. Each figure is read with indexed queries on
+    student_id and kept for `ttl` seconds, and concurrent misses for the
+    same key share one read.
+
+    `connect` returns the database; it is called once per process, since a
+    MongoClient must not be shared across a fork. A stand-in such as
+    mongomock can be passed for testing.
+    """
+
+    def __init__(
+        self,
+        connect,
+        ttl=300,
+        max_entries=10000,
+        marks_limit=5,
+        clock=time.monotonic,
+        now=lambda: datetime.now(timezone.utc),
+    ):
+        self._connect = connect
+        self._database = None
+        self._database_pid = None
+        self._database_lock = threading.Lock()
+        self.marks_limit = marks_limit
+        self._now = now
+        self._cache = ResponseCache(max_entries=max_entries, ttl=ttl, clock=clock)
+        self._reads = SingleFlight()
+        self.errors = 0
+
+    def database(self):
+        if self._database_pid != os.getpid():
+            with self._database_lock:
+                if self._database_pid != os.getpid():
+                    self._database = self._connect()
+                    self._database_pid = os.getpid()
+        return self._database
+
+    # Returns the cached value for key, reading it with load() on a miss.
+    # A failed read is not cached and returns None.
+    def _read_through(self, key, load):
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+        flight, leader = self._reads.join(key)
+        if not leader:
+            return flight.result()
+        try:
+            value = load()
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self._reads.finish(key, value)
+        self._cache.put(key, value)
+        return value
+
+    def students(self, identity):
+        """Students the caller may see, as [{"student_id", "name"}]"""
+        return self._read_through(
+            ("students", identity.role, identity.user_id),
+            lambda: self._load_students(identity),
+        )
+
+    def _load_students(self, identity):
+        database = self.database()
+        try:
+            user_id = ObjectId(identity.user_id)
+        except InvalidId:
+            return []
+        projection = {"_id": 0, "student_id": 1, "name": 1}
+        if identity.role == "parent":
+            parent = database[PARENTS].find_one({"_id": user_id}, {"parent_id": 1})
+            if parent is None:
+                return []
+            query = {"parent_id": parent["parent_id"]}
+        elif identity.role == "teacher":
+            teacher = database[TEACHERS].find_one({"_id": user_id}, {"teacher_id": 1})
+            if teacher is None:
+                return []
+            student_ids = set()
+            for record in database[CLASSES].find(
+                {"teacherId": teacher["teacher_id"]}, {"students": 1}
+            ):
+                student_ids.update(record.get("students", []))
+            query = {"student_id": {"$in": sorted(student_ids)}}
+        else:
+            return []
+        return list(database[STUDENTS].find(query, projection))
+
+    def attendance(self, student_id):
+        """Days present and recorded, this month and overall"""
+        return self._read_through(
+            ("attendance", student_id), lambda: self._load_attendance(student_id)
+        )
+
+    def _load_attendance(self, student_id):
+        attendance = self.database()[ATTENDANCE]
+        month_start = self._now().replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        counts = {}
+        for period, since in (("month", month_start), ("overall", None)):
+            query = {"student_id": student_id}
+            if since is not None:
+                query["date"] = {"$gte": since}
+            total = attendance.count_documents(query)
+            present = attendance.count_documents({**query, "status": "Present"})
+            counts[period] = (present, total)
+        return counts
+
+    def marks(self, student_id):
+        """Most recent marks, newest first"""
+        return self._read_through(
+            ("marks", student_id), lambda: self._load_marks(student_id)
+        )
+
+    def _load_marks(self, student_id):
+        cursor = (
+            self.database()[MARKS]
+            .find(
+                {"student_id": student_id},
+                {"_id": 0, "subject": 1, "value": 1, "maxMarks": 1, "examType": 1},
+            )
+            .sort("date", -1)
+            .limit(self.marks_limit)
+        )
+        return list(cursor)
+
+    def fees(self, student_id):
+        """Pending fee payments and their total"""
+        return self._read_through(
+            ("fees", student_id), lambda: self._load_fees(student_id)
+        )
+
+    def _load_fees(self, student_id):
+        pending = list(
+            self.database()[FEE_PAYMENTS].find(
+                {"student_id": student_id, "paymentStatus": "Pending"},
+                {"_id": 0, "feeType": 1, "amountPaid": 1},
+            )
+        )
+        return {
+            "pending": len(pending),
+            "amount": sum(payment.get("amountPaid", 0) for payment in pending),
+            "feeTypes": sorted(
+                {payment.get("feeType", "Other") for payment in pending}
+            ),
+        }
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        cache = self._cache.stats()
+        reads = self._reads.stats()
+        return {
+            "entries": cache["entries"],
+            "hits": cache["hits"],
+            "misses": cache["misses"],
+            "hitRatio": cache["hitRatio"],
+            "reads": reads["calls"],
+            "coalesced": reads["coalesced"],
+            "errors": self.errors,
+        }
+
+
+_student_id_pattern = re.compile(r"\b[A-Za-z]*\d[\w-]*\b")
+
+
+# Function to pick the student a message is about from those the caller may
+# see: the only one, or the one named or identified in the message
+def pick_student(message, students):
+    if len(students) == 1:
+        return students[0]
+    lowered = message.lower()
+    mentioned = {token.lower() for token in _student_id_pattern.findall(message)}
+    for student in students:
+        if str(student.get("student_id", "")).lower() in mentioned:
+            return student
+    for student in students:
+        name = str(student.get("name", "")).lower()
+        if name and (name in lowered or name.split()[0] in lowered.split()):
+            return student
+    return None
@@ -0,0 +1,10 @@
+# The chatbot modules import each other as siblings, so tests run them from
+# api/controllers the way gunicorn does
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tests never reach Gemini, and a built FAQ file would answer from the cache
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ["CHATBOT_FAQ_FILE"] = ""
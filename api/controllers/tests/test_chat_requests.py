@@ -0,0 +1,50 @@
+import asyncio
+
+import httpx
+import pytest
+
+import chatbot
+import chatbot_asgi
+
+NOT_OBJECTS = [[], "hi", 3]
+
+
+@pytest.mark.parametrize("path", ["/chat", "/chat/stream"])
+@pytest.mark.parametrize("body", NOT_OBJECTS)
+def test_flask_rejects_a_body_that_is_not_an_object(path, body):
+    response = chatbot.app.test_client().post(path, json=body)
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Expected a JSON object"}
+
+
+@pytest.mark.parametrize("body", [[[]], ["hi"], {"items": [3]}])
+def test_flask_rejects_batch_items_that_are_not_objects(body):
+    response = chatbot.app.test_client().post("/chat/batch", json=body)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def post_asgi(path, body):
+    async def send():
+        transport = httpx.ASGITransport(app=chatbot_asgi.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await client.post(path, json=body)
+
+    return asyncio.run(send())
+
+
+@pytest.mark.parametrize("path", ["/chat", "/chat/stream"])
+@pytest.mark.parametrize("body", NOT_OBJECTS)
+def test_asgi_rejects_a_body_that_is_not_an_object(path, body):
+    response = post_asgi(path, body)
+    assert response.status_code == 400
+    assert response.json() == {"error": "Expected a JSON object"}
+
+
+@pytest.mark.parametrize("body", [[[]], ["hi"], {"items": [3]}])
+def test_asgi_rejects_batch_items_that_are_not_objects(body):
+    response = post_asgi("/chat/batch", body)
+    assert response.status_code == 400
+    assert "error" in response.json()
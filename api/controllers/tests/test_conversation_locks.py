@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chatbot
+import conversation_store
+from chatbot_bench import echo_turn, ordering_violations
+from conversation_locks import ConversationLocks
+
+
+# Function to start `count` threads that each take the conversation and note
+# their index, starting the next one only once the last is queued
+def queue_turns(locks, conversation_id, count, order):
+    def turn(index):
+        with locks.hold(conversation_id):
+            order.append(index)
+
+    threads = []
+    for index in range(count):
+        thread = threading.Thread(target=turn, args=(index,))
+        thread.start()
+        threads.append(thread)
+        while locks.stats()["queuedTurns"] < index + 1:
+            time.sleep(0.001)
+    return threads
+
+
+def test_turns_of_one_conversation_run_in_arrival_order():
+    locks = ConversationLocks(stripes=4)
+    order = []
+    locks.acquire("c1")
+    threads = queue_turns(locks, "c1", 20, order)
+    locks.release("c1")
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == list(range(20))
+    assert locks.stats()["heldConversations"] == 0
+
+
+def test_async_turns_of_one_conversation_run_in_arrival_order():
+    locks = ConversationLocks(stripes=4)
+    order = []
+
+    async def turn(index):
+        async with locks.hold_async("c1"):
+            order.append(index)
+            await asyncio.sleep(0)
+
+    async def run():
+        locks.acquire("c1")
+        tasks = []
+        for index in range(20):
+            tasks.append(asyncio.create_task(turn(index)))
+            while locks.stats()["queuedTurns"] < index + 1:
+                await asyncio.sleep(0)
+        locks.release("c1")
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == list(range(20))
+
+
+def test_different_conversations_do_not_wait_for_each_other():
+    # Every stripe is shared, so only the per-conversation queues can keep
+    # the turns apart
+    locks = ConversationLocks(stripes=1)
+    inside = threading.Barrier(8, timeout=5)
+
+    def turn(conversation_id):
+        with locks.hold(conversation_id):
+            inside.wait()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(turn, [f"c{index}" for index in range(8)]))
+    assert not inside.broken
+
+
+def test_concurrent_turns_keep_every_conversation_in_order(monkeypatch):
+    conversations, turns = 8, 6
+    conversation_ids = [f"order_{index}" for index in range(conversations)]
+    store = conversation_store.MemoryConversationStore(max_messages=2 * turns)
+    monkeypatch.setattr(chatbot, "conversations", store)
+    monkeypatch.setattr(chatbot, "conversation_locks", ConversationLocks())
+    monkeypatch.setattr(chatbot.model_router, "hedge_after", 0)
+    monkeypatch.setattr(
+        chatbot.get_client().models, "generate_content", echo_turn(0.005)
+    )
+    chatbot.response_cache.clear()
+
+    # Turns of one conversation are sent back to back so they race for it
+    jobs = [
+        (f"turn {turn} of conversation {index}", conversation_id)
+        for index, conversation_id in enumerate(conversation_ids)
+        for turn in range(turns)
+    ]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(
+            executor.map(lambda job: chatbot.run_turn(job[0], "teacher", job[1]), jobs)
+        )
+
+    assert ordering_violations(store, conversation_ids, turns) == 0
+    for index, conversation_id in enumerate(conversation_ids):
+        questions = [
+            entry["content"]
+            for entry in store.history(conversation_id)
+            if entry["role"] == "user"
+        ]
+        assert sorted(questions) == [
+            f"turn {turn} of conversation {index}" for turn in range(turns)
+        ]
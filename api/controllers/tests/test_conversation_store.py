@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from conversation_store import RedisConversationStore, SQLiteConversationStore
+
+
+def turns(count):
+    entries = []
+    for index in range(count):
+        entries.append({"role": "user", "content": f"question {index}"})
+        entries.append({"role": "assistant", "content": f"answer {index}"})
+    return entries
+
+
+def test_sqlite_fold_past_the_cap_before_a_prune(tmp_path):
+    store = SQLiteConversationStore(
+        str(tmp_path / "conversations.db"), max_messages=4, prune_interval=3600
+    )
+    # The first append prunes, so every later row past the cap stays put
+    for entry in turns(10):
+        store.append("c1", entry)
+
+    history = store.history("c1")
+    assert [entry["content"] for entry in history] == [
+        "question 8",
+        "answer 8",
+        "question 9",
+        "answer 9",
+    ]
+    assert store.fold("c1", history[:2], "summary of turn 8")
+    assert store.summary("c1") == "summary of turn 8"
+    assert store.history("c1") == history[2:]
+    # A fold computed from a stale read is dropped
+    assert not store.fold("c1", history[:2], "stale")
+    assert store.summary("c1") == "summary of turn 8"
+
+
+@pytest.fixture
+def redis_store():
+    fakeredis = pytest.importorskip("fakeredis")
+    store = RedisConversationStore.__new__(RedisConversationStore)
+    super(RedisConversationStore, store).__init__(max_messages=4)
+    store.prefix = "test:"
+    store._redis = fakeredis.FakeRedis()
+    return store
+
+
+def test_redis_fold(redis_store):
+    redis_store.append("c1", *turns(3))
+    history = redis_store.history("c1")
+    assert redis_store.fold("c1", history[:2], "summary")
+    assert redis_store.summary("c1") == "summary"
+    assert redis_store.history("c1") == history[2:]
+
+
+def test_redis_fold_loses_to_a_concurrent_append(redis_store, monkeypatch):
+    redis_store.append("c1", *turns(2))
+    history = redis_store.history("c1")
+    client = redis_store._redis
+    pipeline = client.pipeline
+
+    # Another worker appends, trimming the left end, between the check and
+    # the trim
+    def racing_pipeline():
+        inner = pipeline()
+        multi = inner.multi
+
+        def append_then_multi():
+            client.rpush(
+                redis_store._messages_key("c1"),
+                *[json.dumps(entry) for entry in turns(3)[-2:]],
+            )
+            client.ltrim(redis_store._messages_key("c1"), -4, -1)
+            return multi()
+
+        inner.multi = append_then_multi
+        return inner
+
+    monkeypatch.setattr(client, "pipeline", racing_pipeline)
+    assert not redis_store.fold("c1", history[:2], "summary")
+    assert redis_store.summary("c1") == ""
+    assert [entry["content"] for entry in redis_store.history("c1")] == [
+        "question 1",
+        "answer 1",
+        "question 2",
+        "answer 2",
+    ]
+
+
+def test_redis_ids_cannot_reach_another_conversations_summary(redis_store):
+    redis_store.append("c1", *turns(2))
+    history = redis_store.history("c1")
+    assert redis_store.fold("c1", history[:2], "summary")
+
+    # Conversation IDs come from clients
+    assert redis_store.history("summary:c1") == []
+    assert redis_store.history("sum:c1") == []
+    redis_store.append("sum:c1", *turns(1))
+    assert redis_store.summary("c1") == "summary"
@@ -0,0 +1,74 @@
+import pytest
+
+from chatbot import feature_indicators, feature_links, get_feature_link
+
+ROLES = ["admin", "parent", "teacher", "principal", "districthead"]
+
+
+# Function to look up a role's link for a feature the way the original nested
+# loops did: the role's own table first, then the feature's table of roles
+def baseline_link(role, feature):
+    if role in feature_links and feature in feature_links[role]:
+        return feature_links[role][feature]
+    if feature in feature_links and role in feature_links[feature]:
+        return feature_links[feature][role]
+    return None
+
+
+@pytest.mark.parametrize("role", ROLES)
+def test_representative_phrases_resolve_to_the_baseline_link(role):
+    checked = 0
+    for feature, indicators in feature_indicators.items():
+        link = baseline_link(role, feature)
+        if link is None:
+            continue
+        assert get_feature_link(indicators[0], role) == link, indicators[0]
+        checked += 1
+    assert checked
+
+
+# Phrases that contain indicators of several features, with the link the
+# nested loops gave: the first listed feature the role has, or its dashboard
+SHARED_PHRASES = [
+    ("parent", "absent", "/dashboard/parent/Attendance"),
+    ("teacher", "absent", "/dashboard/teacher/attendance"),
+    ("principal", "absent", "/dashboard/principal"),
+    ("parent", "child profile", "/dashboard/parent/childProfile"),
+    ("parent", "my kid profile", "/dashboard/parent/childProfile"),
+    ("teacher", "child profile", "/dashboard/teacher/profile"),
+    ("principal", "child profile", "/dashboard/principal/profile"),
+    ("parent", "school fees", "/dashboard/parent/Fees"),
+    ("parent", "payment details", "/dashboard/parent/Fees"),
+    ("principal", "school fees", "/dashboard/principal/schoolFees"),
+    ("principal", "fee structure", "/dashboard/principal/schoolFees"),
+    ("teacher", "school fees", "/dashboard/teacher"),
+    ("parent", "money allocation", "/dashboard/parent/Fees"),
+    ("principal", "money allocation", "/dashboard/principal/budgetUsage"),
+    ("districthead", "money allocation", "/dashboard/districthead/budgets"),
+    ("parent", "leave requests", "/dashboard/parent"),
+    ("teacher", "leave requests", "/dashboard/teacher/leave"),
+    ("teacher", "approve leave", "/dashboard/teacher/leave"),
+    ("principal", "leave requests", "/dashboard/principal/leaveApprovals"),
+    ("principal", "leave management", "/dashboard/principal/leaveApprovals"),
+    ("parent", "parent teacher meeting", "/dashboard/parent/PT Meetings"),
+    ("teacher", "parent teacher meeting", "/dashboard/teacher/parentInteraction"),
+    ("principal", "parent teacher meeting", "/dashboard/principal/meetings"),
+    ("districthead", "parent teacher meeting", "/dashboard/districthead/meetings"),
+    ("principal", "examination schedule", "/dashboard/principal/meetings"),
+    ("teacher", "examination schedule", "/dashboard/teacher"),
+]
+
+# Where the index deliberately differs from the nested loops, which took the
+# first listed feature whose indicator appeared anywhere in the message
+CHANGED_PHRASES = [
+    # "schedule" also indicates meetings, but the longer indicator names exams
+    ("districthead", "examination schedule", "/dashboard/districthead/exams"),
+    # "absent" also indicates attendance, but "leave" indicates only leave
+    ("teacher", "absent and need leave", "/dashboard/teacher/leave"),
+]
+
+
+@pytest.mark.parametrize("role, message, link", SHARED_PHRASES + CHANGED_PHRASES)
+def test_shared_phrases_resolve_to_one_link(role, message, link):
+    assert get_feature_link(message, role) == link
+    assert get_feature_link(message.upper(), role) == link
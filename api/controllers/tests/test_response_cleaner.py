@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from chatbot import ResponseCleaner, clean_response
+
+REPLIES = [
+    "Your **attendance** is 92% this term.",
+    "**Fees**: the next payment is due on 5 May.\n\nPay it from the fees page.",
+    "1. **Open the marks page**: pick the class.\n2. **Upload**: choose the file.",
+    "Steps:\n1.\n**Log in**: use your teacher account.\n2.\n**Upload marks**",
+    "Here's my reasoning and response: the timetable is on the classes page.",
+    "As a helpful AI assistant, I can show you the leave requests.",
+    "```\nHere's my reasoning and response:\n``` **Result**: 3 students absent.",
+    "1. **Step**: Here's my reasoning and response: **bold** then words",
+    "A *single* star, an open ** bold\nand a line with 10. at the end 10.",
+    "   \n\n Leading space, trailing space and **unclosed bold   \n\n",
+]
+PIECES = [
+    "**",
+    "*",
+    "**Step**:",
+    "1.",
+    "2. ",
+    "\n1. ",
+    "10.\n",
+    "Here's my reasoning and response:",
+    "As a helpful AI assistant",
+    "As a",
+    " helpful",
+    "```",
+    "`",
+    "Hello",
+    "world",
+    ", ",
+    ".",
+    ": ",
+    " ",
+    "\n",
+    "\n\n",
+]
+
+
+def stream(text, rng, max_chunk=8):
+    cleaner = ResponseCleaner()
+    out = []
+    start = 0
+    while start < len(text):
+        end = start + rng.randint(1, max_chunk)
+        out.append(cleaner.feed(text[start:end]))
+        start = end
+    out.append(cleaner.flush())
+    return "".join(out)
+
+
+@pytest.mark.parametrize("text", REPLIES)
+def test_streamed_replies_match_clean_response(text):
+    rng = random.Random(text)
+    for _ in range(50):
+        assert stream(text, rng) == clean_response(text)
+
+
+def test_random_replies_split_across_chunks_match_clean_response():
+    rng = random.Random(17)
+    for _ in range(2000):
+        text = "".join(rng.choice(PIECES) for _ in range(rng.randint(1, 40)))
+        assert stream(text, rng) == clean_response(text)
+
+
+def test_finished_lines_are_not_held():
+    # A "**" can only open a bold span on the line still arriving, so repeated
+    # headings over open bold markers are let go as their lines end
+    text = "1.\n**" * 5000
+    cleaner = ResponseCleaner()
+    out = []
+    for start in range(0, len(text), 20):
+        out.append(cleaner.feed(text[start : start + 20]))
+        assert len(cleaner._pending) < 10
+    out.append(cleaner.flush())
+    assert "".join(out) == clean_response(text)
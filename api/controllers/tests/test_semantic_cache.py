@@ -0,0 +1,62 @@
+import pytest
+
+import chatbot
+from model_guard import ModelUnavailable
+from response_cache import SemanticCache
+
+
+class FakeEmbedding:
+    def __init__(self, values):
+        self.values = values
+
+
+class FakeEmbedResponse:
+    def __init__(self, values):
+        self.embeddings = [FakeEmbedding(values)]
+
+
+@pytest.fixture
+def embed_calls(monkeypatch):
+    calls = []
+
+    def embed_content(model=None, contents=None, config=None):
+        calls.append(config)
+        return FakeEmbedResponse([1.0, 0.0, 0.0])
+
+    monkeypatch.setattr(chatbot.get_client().models, "embed_content", embed_content)
+    monkeypatch.setattr(
+        chatbot, "semantic_cache", SemanticCache(chatbot.gemini_embedding)
+    )
+    return calls
+
+
+def cached_turn(message):
+    turn = chatbot.ChatTurn("c1", {"role": "user", "content": message})
+    turn.cache_key = chatbot.response_cache_key(message, "teacher", [])
+    turn.intent = chatbot.match_intent(message, "teacher")
+    return turn
+
+
+def test_embedding_waits_for_a_token_under_the_model_deadline(embed_calls):
+    assert chatbot.gemini_embedding("where are my classes") == [1.0, 0.0, 0.0]
+    assert embed_calls[0].http_options.timeout <= chatbot.MODEL_DEADLINE * 1000
+
+
+def test_open_breaker_skips_the_semantic_lookup(embed_calls, monkeypatch):
+    monkeypatch.setattr(chatbot.model_breaker, "allow", lambda: False)
+    with pytest.raises(ModelUnavailable):
+        chatbot.gemini_embedding("where are my classes")
+
+    turn = cached_turn("where can I see my classes")
+    assert chatbot.lookup_cached_response(turn, "where can I see my classes") is None
+    assert turn.embedding is None
+    assert embed_calls == []
+
+
+def test_no_rate_limit_token_skips_the_semantic_lookup(embed_calls, monkeypatch):
+    monkeypatch.setattr(chatbot.model_bucket, "acquire", lambda timeout: False)
+
+    turn = cached_turn("where can I see my classes")
+    assert chatbot.lookup_cached_response(turn, "where can I see my classes") is None
+    assert turn.embedding is None
+    assert embed_calls == []